@@ -0,0 +1,76 @@
+import threading
+import queue
+
+
+class _WorkerError(object):
+    def __init__(self, error):
+        self.error = error
+
+
+class BatchPrefetcher(object):
+    """
+    generates batches on worker threads while the model is trained
+        generate_fn     called without arguments, returns one batch
+        n_batches       number of batches of one iteration (epoch)
+        workers         number of worker threads, 0 generates in main thread
+        depth           max number of ready batches waiting in queue
+    numpy gathers and sparse products release the GIL
+    --> batch generation overlaps with forward and backward pass
+    """
+
+    def __init__(self, generate_fn, n_batches, workers=1, depth=2):
+        self.generate_fn = generate_fn
+        self.n_batches = n_batches
+        self.workers = workers
+        self.depth = depth
+
+    def __len__(self):
+        return self.n_batches
+
+    def __iter__(self):
+        if self.workers <= 0:
+            for _ in range(self.n_batches):
+                yield self.generate_fn()
+            return
+
+        ready = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        lock = threading.Lock()
+        remaining = [self.n_batches]
+
+        def put(item):
+            # wait for free slot but give up as soon as iteration stopped
+            while not stop.is_set():
+                try:
+                    ready.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def work():
+            while not stop.is_set():
+                with lock:
+                    if remaining[0] == 0:
+                        return
+                    remaining[0] -= 1
+                try:
+                    put(self.generate_fn())
+                except Exception as error:
+                    put(_WorkerError(error))
+                    return
+
+        threads = [threading.Thread(target=work, daemon=True)
+                   for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            for _ in range(self.n_batches):
+                item = ready.get()
+                if isinstance(item, _WorkerError):
+                    raise item.error
+                yield item
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
@@ -0,0 +1,111 @@
+import numpy as np
+
+import hashlib
+import os
+
+
+def fingerprint(*columns):
+    """
+    hash over the content and order of all given columns
+    """
+
+    sha = hashlib.sha1()
+    for column in columns:
+        sha.update("\n".join(str(value) for value in column).encode())
+        sha.update(b"\0")
+    return sha.hexdigest()[:16]
+
+
+def split_manifest_file(cache_dir, key, seed):
+    name = "split-{}-{}.npz".format(key, seed)
+    return os.path.join(cache_dir, name)
+
+
+def load_split_manifest(cache_dir, key, seed):
+    """
+    returns saved split or None if no split exists for key and seed
+    """
+
+    file_name = split_manifest_file(cache_dir, key, seed)
+    if not os.path.isfile(file_name):
+        return None
+    with np.load(file_name) as manifest:
+        return {name: manifest[name] for name in manifest.files}
+
+
+def save_split_manifest(cache_dir, key, seed, manifest):
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    file_name = split_manifest_file(cache_dir, key, seed)
+    # np.savez appends .npz to names without it
+    tmp_file = file_name[:-len(".npz")] + ".tmp.npz"
+    np.savez(tmp_file, **manifest)
+    os.replace(tmp_file, file_name)
+
+
+LOADER_STATE = "state.npz"
+
+
+def file_fingerprint(paths, *values):
+    """
+    hash over path, size and modification time of all files plus values
+    changed or touched files give a new key, content is not read
+    """
+
+    sha = hashlib.sha1()
+    for path in paths:
+        stat = os.stat(path)
+        sha.update("{}\0{}\0{}\n".format(
+            path, stat.st_size, stat.st_mtime_ns).encode())
+    for value in values:
+        sha.update(str(value).encode())
+        sha.update(b"\0")
+    return sha.hexdigest()[:16]
+
+
+def list_files(path):
+    """
+    all files below path in walk order
+    """
+
+    return [os.path.join(root, file)
+            for root, _, files in os.walk(path) for file in files]
+
+
+def loader_state_dir(cache_dir, key):
+    return os.path.join(cache_dir, "loader-{}".format(key))
+
+
+def shape_pack_dir(cache_dir, key):
+    """
+    packed nrrd shapes, keyed by the nrrd files only --> shared by all
+    loader states (changed captions or vocabulary reuse the shapes)
+    """
+
+    return os.path.join(cache_dir, "shapes-{}".format(key))
+
+
+def load_loader_state(cache_dir, key):
+    """
+    returns saved arrays of prepared loader or None if nothing is saved for key
+    """
+
+    file_name = os.path.join(loader_state_dir(cache_dir, key), LOADER_STATE)
+    if not os.path.isfile(file_name):
+        return None
+    with np.load(file_name) as state:
+        return {name: state[name] for name in state.files}
+
+
+def save_loader_state(cache_dir, key, state):
+    """
+    state is written last --> entry is complete once it exists
+    """
+
+    directory = loader_state_dir(cache_dir, key)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    file_name = os.path.join(directory, LOADER_STATE)
+    tmp_file = file_name[:-len(".npz")] + ".tmp.npz"
+    np.savez(tmp_file, **state)
+    os.replace(tmp_file, file_name)
@@ -1,8 +1,6 @@
-import nrrd
-import csv
 import pandas as pd
 import numpy as np
-import collections
+import scipy.sparse
 
 import sys
 import os
@@ -10,12 +8,29 @@ import os
 from sklearn.utils import shuffle
 
 from dataloader.TextDataVectorization import TxtVectorization
+from dataloader.DataCache import fingerprint, load_split_manifest, \
+    save_split_manifest, file_fingerprint, list_files, loader_state_dir, \
+    shape_pack_dir, load_loader_state, save_loader_state
+from dataloader.ShapeStore import PACKED_DATA, PACKED_INDEX, \
+    packed_shapes_exist, pack_nrrd_directory, load_packed_shapes, \
+    load_packed_data, save_packed_data, find_nrrd_files, read_nrrd, \
+    read_nrrd_files, SparseShapes, LazyShapes, save_sparse_shapes, \
+    load_sparse_shapes
+from dataloader.PrimitivesStore import PACKED_DESCRIPTIONS, \
+    packed_primitives_exist, pack_primitives, load_primitives
+
+
+# bump whenever the saved loader state changes its layout
+LOADER_STATE_VERSION = 3
 
 
 class TripletShape2Text(object):
     """
-    Stores Triples with one shape and a positive and a negative
-    matching description
+    Stores batch of triplets with shapes and positive and negative
+    matching descriptions as contiguous arrays
+        shape       [bs, 32, 32, 32, 4]
+        pos_desc    [bs, max_length]
+        neg_desc    [bs, max_length]
     """
 
     def __init__(self, shape, pos_desc, neg_desc):
@@ -26,8 +41,11 @@ class TripletShape2Text(object):
 
 class TripletText2Shape(object):
     """
-    Stores Triplets with one description and a negative and positive
-    matching shape
+    Stores batch of triplets with descriptions and positive and negative
+    matching shapes as contiguous arrays
+        desc        [bs, max_length]
+        pos_shape   [bs, 32, 32, 32, 4]
+        neg_shape   [bs, 32, 32, 32, 4]
     """
 
     def __init__(self, desc, pos_shape, neg_shape):
@@ -41,85 +59,275 @@ class Loader(object):
     Loader class
         tries to load given files
             either primitives ot shapenet data
+            shapenet shapes either from nrrd directory or packed store
+            primitives either from directory or packed primitives
         handles exceptions
+        saves prepared state in cache directory (optional)
+            loaded again as long as input files and config do not change
+            data_key is the fingerprint of these inputs
         adds category to shape data
-        converts dict{dict{}} to dict{list[]}
-        codes all descriptions to vector
+        holds descriptions column wise: dict{np.array}
+        codes all descriptions to one [N, max_length] matrix
+        codes all modelIds and categories to integer
     """
 
     def __init__(self, config):
-        if config['dataset'] == "shapenet":
+        n_workers = config.get('ingest_workers', 1)
+        shape_storage = config.get('shape_storage', "dense")
+        shape_cache_bytes = config.get('shape_cache_bytes', 2**30)
+        cache_dir = config['directories'].get('cache')
+        packed_data = config['directories'].get('packed_data')
+        packed_primitives = config['directories'].get('packed_primitives')
+        if config['dataset'] != "shapenet":
+            packed_data = None
+        if config['dataset'] != "primitives":
+            packed_primitives = None
+
+        try:
+            self.txt_vectorization = TxtVectorization(
+                config['directories']['vocabulary'])
+        except:
+            sys.exit("ERROR! Loader can't load given vocabulary")
+
+        self.length_voc = len(self.txt_vectorization.voc_list)
+
+        # packed store is build once and afterwards only memory mapped
+        if packed_data is not None and not packed_shapes_exist(packed_data):
             try:
-                self.descriptions = pd.read_csv(
-                    config['directories']['train_labels']).to_dict()
+                print("...packing shapes into {}".format(packed_data))
+                pack_nrrd_directory(
+                    config['directories']['train_data'], packed_data,
+                    n_workers)
             except:
-                sys.exit("ERROR! Loader can't load given labels")
+                sys.exit("ERROR! Loader can't load given packed data")
 
+        # primitives are parsed once with a fixed description assignment
+        if packed_primitives is not None and \
+                not packed_primitives_exist(packed_primitives):
             try:
-                self.shapes = parse_directory_for_nrrd(
-                    config['directories']['train_data'])
+                print("...packing primitives into {}".format(packed_primitives))
+                pack_primitives(
+                    config['directories']['primitives'], config['categorize'],
+                    packed_primitives, n_workers)
             except:
-                sys.exit("ERROR! Loader can't load given data")
+                sys.exit("ERROR! Loader was not able to parse given directory")
 
+        # prepared state is saved under a fingerprint of all inputs
+        # shapes go to packed store, to a shape pack of the nrrd files
+        # (shapenet) or next to the state (shuffled primitives)
+        self.data_key = self.__fingerprint(config, packed_data)
+        state = None
+        shape_dir = packed_data
+        if cache_dir is not None:
+            state_key = self.data_key
+            state = load_loader_state(cache_dir, state_key)
+            # shape pack may have been deleted from the cache
+            if state is not None and shape_dir is None and \
+                    not os.path.isfile(os.path.join(
+                        str(state['shape_dir']), PACKED_DATA)):
+                state = None
+
+        if state is not None:
+            print("...loaded prepared data from cache")
+            self.__restore_state(state)
+            if shape_dir is None:
+                shape_dir = str(state['shape_dir'])
+            self.shapes['data'] = load_packed_data(shape_dir)
+        else:
+            if cache_dir is not None and shape_dir is None:
+                if config['dataset'] == "shapenet":
+                    shape_dir = shape_pack_dir(cache_dir, file_fingerprint(
+                        [file for _, file in find_nrrd_files(
+                            config['directories']['train_data'])]))
+                else:
+                    shape_dir = loader_state_dir(cache_dir, state_key)
+            self.__prepare(config, n_workers, shape_storage, shape_cache_bytes,
+                           packed_data, shape_dir)
+            if cache_dir is not None:
+                if shape_dir != packed_data and \
+                        not os.path.isfile(os.path.join(shape_dir, PACKED_DATA)):
+                    save_packed_data(shape_dir, self.shapes['data'])
+                state = self.__state()
+                state['shape_dir'] = np.array(shape_dir)
+                save_loader_state(cache_dir, state_key, state)
+
+        self.__store_shapes(shape_storage, shape_cache_bytes, shape_dir)
+
+    def __prepare(self, config, n_workers, shape_storage, shape_cache_bytes,
+                  packed_data, shape_dir):
+        """
+        reads all inputs and codes descriptions, modelIds and categories
+        shape_dir (not None) --> nrrd files are packed there (once) and
+                                 memory mapped
+        """
+
+        if config['dataset'] == "shapenet":
+            try:
+                self.descriptions = read_description_columns(
+                    config['directories']['train_labels'])
+            except:
+                sys.exit("ERROR! Loader can't load given labels")
+
+            if shape_dir is not None:
+                try:
+                    if not packed_shapes_exist(shape_dir):
+                        pack_nrrd_directory(
+                            config['directories']['train_data'], shape_dir,
+                            n_workers=n_workers)
+                    self.shapes = load_packed_shapes(shape_dir)
+                except:
+                    sys.exit("ERROR! Loader can't load given packed data")
+            else:
+                try:
+                    self.shapes = parse_directory_for_nrrd(
+                        config['directories']['train_data'], n_workers,
+                        shape_storage, shape_cache_bytes)
+                except:
+                    sys.exit("ERROR! Loader can't load given data")
+
+            # categories always follow the current labels
             self.__add_category_to_shape()
-            self.__description_to_lists()
 
         if config['dataset'] == "primitives":
             try:
-                self.shapes, self.descriptions = parse_primitives(
-                    config['directories']['primitives'], config['categorize'])
+                self.shapes, self.descriptions = load_primitives(
+                    config['directories']['primitives'], config['categorize'],
+                    config['directories'].get('packed_primitives'), n_workers)
             except:
                 sys.exit("ERROR! Loader was not able to parse given directory")
             self.__shuffle_data()
 
-        try:
-            self.txt_vectorization = TxtVectorization(
-                config['directories']['vocabulary'])
-        except:
-            sys.exit("ERROR! Loader can't load given vocabulary")
+        self.__description_to_vector()
+        self.__encode_columns()
 
-        self.length_voc = len(self.txt_vectorization.voc_list)
+    def __fingerprint(self, config, packed_data):
+        """
+        key of prepared state
+            path, size and modification time of all input files
+            config keys changing the prepared data
+        """
 
-        self.__description_to_vector()
+        directories = config['directories']
+        files = [directories['vocabulary']]
+        if config['dataset'] == "shapenet":
+            files.append(directories['train_labels'])
+            if packed_data is not None:
+                files += [os.path.join(packed_data, PACKED_DATA),
+                          os.path.join(packed_data, PACKED_INDEX)]
+            else:
+                files += [file for _, file in
+                          find_nrrd_files(directories['train_data'])]
+        if config['dataset'] == "primitives":
+            packed_primitives = directories.get('packed_primitives')
+            if packed_primitives is not None:
+                files += [os.path.join(packed_primitives, name) for name in
+                          [PACKED_DATA, PACKED_INDEX, PACKED_DESCRIPTIONS]]
+            else:
+                files += list_files(directories['primitives'])
+
+        return file_fingerprint(files, LOADER_STATE_VERSION,
+                                config['dataset'], config['categorize'],
+                                self.txt_vectorization.max_desc_length)
+
+    def __state(self):
+        """
+        all prepared columns except shape data as flat dict of arrays
+        """
+
+        state = dict()
+        for prefix, data in [("descriptions", self.descriptions),
+                             ("shapes", self.shapes)]:
+            for key, column in data.items():
+                if key == 'data':
+                    continue
+                column = np.asarray(column)
+                if column.dtype == object:
+                    column = column.astype(str)
+                state["{}.{}".format(prefix, key)] = column
+        state['model_ids'] = np.asarray(self.model_ids, dtype=str)
+        state['categories'] = np.asarray(self.categories, dtype=str)
+        return state
+
+    def __restore_state(self, state):
+        self.descriptions = dict()
+        self.shapes = dict()
+        for name, column in state.items():
+            prefix, _, key = name.partition(".")
+            if prefix == "descriptions":
+                self.descriptions[key] = column
+            if prefix == "shapes":
+                self.shapes[key] = column
+        self.model_ids = state['model_ids'].tolist()
+        self.categories = state['categories'].tolist()
 
     def __add_category_to_shape(self):
         """
         shape is needed for
             calculating the ndcg
             smart batches
+        one hash join on modelId, first matching description wins
         """
 
-        category = list()
-        for _, shape_id in enumerate(self.shapes['modelId']):
-            cat = "none"
-            found_category = False
-            for key, value in self.descriptions["modelId"].items():
-                if value == shape_id:
-                    found_category = True
-                    break
-            if found_category == True:
-                cat = self.descriptions['category'][key]
-            category.append(cat)
-        self.shapes['category'] = category
+        self.shapes['category'] = category_join(
+            self.shapes['modelId'], self.descriptions['modelId'],
+            self.descriptions['category'])
 
-    def __description_to_lists(self):
+    def __encode_columns(self):
         """
-        pandas stores dict within dict which contains idx as key
-        this functions converts these dicts into one list
+        modelId and category are stored as numpy arrays
+        plus integer codes shared by shapes and descriptions
+            same modelId same code      self.model_ids[code]
+            same category same code     self.categories[code]
         """
 
-        for key, _ in self.descriptions.items():
-            data_list = []
-            for _, v in self.descriptions[key].items():
-                data_list.append(v)
-            self.descriptions[key] = data_list
+        for data in [self.shapes, self.descriptions]:
+            data['modelId'] = np.asarray(data['modelId'], dtype=str)
+            data['category'] = np.asarray(data['category'], dtype=str)
+
+        self.model_ids, self.shapes['model_code'], \
+            self.descriptions['model_code'] = encode_shared(
+                self.shapes['modelId'], self.descriptions['modelId'])
+        self.categories, self.shapes['category_code'], \
+            self.descriptions['category_code'] = encode_shared(
+                self.shapes['category'], self.descriptions['category'])
+
+    def __store_shapes(self, shape_storage, shape_cache_bytes, shape_dir):
+        """
+        dense:      array or memory map [N, 32, 32, 32, 4]
+        sparse:     only occupied voxels, dense shapes rebuild per batch
+                    saved next to packed shapes (shape_dir) and memory
+                    mapped afterwards
+        lazy:       shapes loaded on access, kept in LRU cache of
+                    shape_cache_bytes
+        """
+
+        if shape_storage == "sparse" and \
+                not isinstance(self.shapes['data'], SparseShapes):
+            sparse = None
+            if shape_dir is not None:
+                sparse = load_sparse_shapes(shape_dir)
+            if sparse is None:
+                sparse = SparseShapes.from_dense(self.shapes['data'])
+                if shape_dir is not None:
+                    save_sparse_shapes(shape_dir, sparse)
+            self.shapes['data'] = sparse
+        if shape_storage == "sparse":
+            print("...sparse shapes use {:.1f} MB".format(
+                self.shapes['data'].nbytes / 2**20))
+
+        if shape_storage == "lazy" and \
+                not isinstance(self.shapes['data'], LazyShapes):
+            self.shapes['data'] = LazyShapes.from_array(
+                self.shapes['data'], shape_cache_bytes)
 
     def __description_to_vector(self):
-        desc_vector_list = list()
-        for desc in self.descriptions["description"]:
-            desc_vector_list.append(self.txt_vectorization.description2vector(
-                desc))
-        self.descriptions["description"] = desc_vector_list
+        """
+        all descriptions are coded at once into one [N, max_length] matrix
+        """
+
+        self.descriptions["description"] = \
+            self.txt_vectorization.descriptions2matrix(
+                self.descriptions["description"])
 
     def __shuffle_data(self):
         """
@@ -146,18 +354,117 @@ class Loader(object):
 
 
 
+class RowIndex(object):
+    """
+    maps each key (modelId, category code) to all rows holding this key
+        built once with one sort --> lookup is a dict access and a slice
+        rows of one key are stored next to each other in one flat array
+        --> all rows with another key are the rows before and after
+    """
+
+    def __init__(self, keys):
+        unique, inverse = np.unique(np.asarray(keys), return_inverse=True)
+        counts = np.bincount(inverse.ravel(), minlength=len(unique))
+        self.keys = unique
+        self.rows = np.argsort(inverse.ravel(), kind='stable')
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+        self.group = dict(zip(unique.tolist(), range(len(unique))))
+
+    def get(self, key):
+        """
+        all rows matching key - empty if key is unknown
+        """
+
+        group = self.group.get(key)
+        if group is None:
+            return self.rows[:0]
+        return self.rows[self.offsets[group]:self.offsets[group + 1]]
+
+    def groups(self, keys):
+        """
+        group number of each key, -1 if key is unknown
+        """
+
+        keys = np.asarray(keys)
+        if len(self.keys) == 0 or len(keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        groups = np.searchsorted(self.keys, keys)
+        groups[groups == len(self.keys)] = 0
+        groups[self.keys[groups] != keys] = -1
+        return groups.astype(np.int64)
+
+    def sample(self, groups):
+        """
+        one random row for each group number
+        """
+
+        start = self.offsets[groups]
+        count = self.offsets[groups + 1] - start
+        pick = (np.random.random_sample(len(groups)) * count).astype(np.int64)
+        return self.rows[start + pick]
+
+    def sample_complement(self, groups):
+        """
+        one random row for each group number which belongs to another group
+            rows of a group are contiguous --> draw position within all other
+            rows and skip over the rows of the group
+        group -1 (unknown key) or a group holding all rows draws from all rows
+        """
+
+        n_rows = len(self.rows)
+        known = groups >= 0
+        start = np.where(known, self.offsets[groups], 0)
+        count = np.where(known, self.offsets[groups + 1], 0) - start
+        count[count == n_rows] = 0
+
+        pick = (np.random.random_sample(len(groups)) *
+                (n_rows - count)).astype(np.int64)
+        pick += count * (pick >= start)
+        return self.rows[pick]
+
+
 class DataLoader(object):
     """
     holds either:
         all data    -->     just retrieval
         train data or
         test data
+    all columns are numpy arrays
+        descriptions['description']     [N, max_length] token matrix
+        model_code, category_code       integer coded modelId, category
+    indexes modelId of shapes and descriptions once
+        valid_shapes        rows of shapes with at least one description
+        valid_descriptions  rows of descriptions with at least one shape
+    bag_of_words holds token counts of all descriptions for smart batches
     """
 
     def __init__(self, descriptions, shapes):
         self.descriptions = descriptions
         self.shapes = shapes
 
+        self.description_index = RowIndex(descriptions['model_code'])
+        self.shape_index = RowIndex(shapes['model_code'])
+
+        # group of matching partner for each row, -1 if there is none
+        self.shape_description_group = self.description_index.groups(
+            shapes['model_code'])
+        self.description_shape_group = self.shape_index.groups(
+            descriptions['model_code'])
+
+        self.valid_shapes = np.flatnonzero(self.shape_description_group >= 0)
+        self.valid_descriptions = np.flatnonzero(
+            self.description_shape_group >= 0)
+
+        self.bag_of_words = bag_of_words(descriptions['description'])
+
+        # rows sorted by category --> negatives are drawn in one step
+        self.shape_category_index = RowIndex(shapes['category_code'])
+        self.description_category_index = RowIndex(
+            descriptions['category_code'])
+        if len(self.shape_category_index.keys) == 1 or \
+                len(self.description_category_index.keys) == 1:
+            print("WARNING! Data contains just one category - negatives share category with anchor")
+
     def get_shape_length(self):
         return len(self.shapes["modelId"])
 
@@ -185,256 +492,140 @@ class TripletLoader(object):
     def __init__(self, config):
         loader = Loader(config)
 
-        # TODO: seed to config?
-        np.random.seed(1200)
+        self.seed = config.get('seed', 1200)
+        np.random.seed(self.seed)
 
         self.bs = config['hyper_parameters']['bs']
         self.oversample = config['hyper_parameters']['oversample']
         self.txt_vectorization = loader.txt_vectorization
         self.length_voc = len(self.txt_vectorization.voc_list)
+        self.model_ids = loader.model_ids
+        self.categories = loader.categories
+        self.data_key = loader.data_key
 
-        self.__split_train_test(loader)
+        self.__split_train_test(loader, config['directories'].get('cache'))
 
-    def __split_train_test(self, loader):
+    def __split_train_test(self, loader, cache_dir=None):
         """
         split 90/10
         first split shapes
-        then look for matching descriptions for shapes and add to corresponding data container
+        then group descriptions by modelId and add them to the split of their shape
+        split is saved as manifest in cache_dir and loaded on later runs
         """
 
-        train_descriptions = {'id': list(), 'modelId': list(), 'description': list(), 'category': list(),
-                              'topLevelSynsetId': list(), 'subSynsetId': list()}
-        test_descriptions = {'id': list(), 'modelId': list(), 'description': list(), 'category': list(),
-                             'topLevelSynsetId': list(), 'subSynsetId': list()}
+        end_train = int(len(loader.shapes['modelId'])*0.9)
+
+        manifest = None
+        if cache_dir is not None:
+            data_key = fingerprint(loader.shapes['modelId'],
+                                   loader.descriptions['modelId'])
+            manifest = load_split_manifest(cache_dir, data_key, self.seed)
+            if manifest is not None:
+                print("...loaded split manifest")
+
+        if manifest is None:
+            description_index = RowIndex(loader.descriptions['model_code'])
+            manifest = {
+                'end_train': np.array(end_train),
+                'train_descriptions': self.__group_descriptions(
+                    description_index, loader.shapes['model_code'][:end_train]),
+                'test_descriptions': self.__group_descriptions(
+                    description_index, loader.shapes['model_code'][end_train:])}
+            if cache_dir is not None:
+                save_split_manifest(cache_dir, data_key, self.seed, manifest)
+
+        end_train = int(manifest['end_train'])
         train_shapes = dict()
         test_shapes = dict()
-
-        end_train = int(len(loader.shapes['modelId'])*0.9)
+        # slicing keeps packed data as memory mapped view
         for key, _ in loader.shapes.items():
-            d1 = list(loader.shapes[key][:end_train])
-            d2 = list(loader.shapes[key][end_train:])
-            train_shapes[key] = d1
-            test_shapes[key] = d2
-
-        # remember_id is needed for primitives
-        #       --> mltiple same shapes and we do not want to
-        #           add same description multiple times
-        remember_id = []
-        for i, shape_id in enumerate(train_shapes['modelId']):
-            if shape_id not in remember_id:
-                idx = [i for i, x in enumerate(
-                    loader.descriptions['modelId']) if x == shape_id]
-                for key, val_list in loader.descriptions.items():
-                    for id in idx:
-                        train_descriptions[key].append(val_list[id])
-                remember_id.append(shape_id)
-
-            print("Generate train split {} of {}".format(
-                i, len(train_shapes['modelId'])), end='\r')
-        print()
-
-        remember_id = []
-        for i, shape_id in enumerate(test_shapes['modelId']):
-            if shape_id not in remember_id:
-                idx = [i for i, x in enumerate(
-                    loader.descriptions['modelId']) if x == shape_id]
-                for key, val_list in loader.descriptions.items():
-                    for id in idx:
-                        test_descriptions[key].append(val_list[id])
-                remember_id.append(shape_id)
+            train_shapes[key] = loader.shapes[key][:end_train]
+            test_shapes[key] = loader.shapes[key][end_train:]
 
-            print("Generate test split {} of {}".format(
-                i, len(test_shapes['modelId'])), end='\r')
-        print()
+        train_descriptions = dict()
+        test_descriptions = dict()
+        for key, val_list in loader.descriptions.items():
+            train_descriptions[key] = val_list[manifest['train_descriptions']]
+            test_descriptions[key] = val_list[manifest['test_descriptions']]
 
         self.train_data = DataLoader(train_descriptions, train_shapes)
         self.test_data = DataLoader(test_descriptions, test_shapes)
 
-    def get_train_batch(self, version):
-        batch = []
-        if version == "s2t":
-            for _ in range(self.bs):
-                rand = np.random.randint(0, self.train_data.get_shape_length())
-                shape_id = self.train_data.shapes["modelId"][rand]
-                shape_category = self.train_data.shapes["category"][rand]
-                shape = self.train_data.shapes['data'][rand]
-
-                pos_id = self.__find_positive_description_id(
-                    shape_id, data="train")
-                # in case of no matching positive description is found
-                while pos_id == None:
-                    rand = np.random.randint(
-                        0, self.train_data.get_shape_length())
-                    shape_id = self.train_data.shapes["modelId"][rand]
-                    shape = self.train_data.shapes['data'][rand]
-
-                    pos_id = self.__find_positive_description_id(
-                        shape_id, data="train")
-
-                pos_desc = self.train_data.descriptions["description"][pos_id]
-
-                neg_id = self.__find_negative_description_id(
-                    shape_category, data="train")
-                neg_desc = self.train_data.descriptions["description"][neg_id]
-
-                triplet = TripletShape2Text(shape, pos_desc, neg_desc)
-                batch.append(triplet)
-        if version == "t2s":
-            for _ in range(self.bs):
-                rand = np.random.randint(
-                    0, self.train_data.get_description_length())
-                desc_id = self.train_data.descriptions['modelId'][rand]
-                desc_category = self.train_data.descriptions['category'][rand]
-                desc = self.train_data.descriptions["description"][rand]
-
-                pos_id = self.__find_positive_shape_id(desc_id, "train")
-
-                # in case of no matching positive shape is found
-                while pos_id == None:
-                    rand = np.random.randint(
-                        0, self.train_data.get_description_length())
-                    desc_id = self.train_data.descriptions['modelId'][rand]
-                    desc = self.train_data.descriptions["description"][rand]
-
-                    pos_id = self.__find_positive_shape_id(
-                        desc_id, data="train")
-
-                pos_shape = self.train_data.shapes['data'][pos_id]
-
-                neg_id = self.__find_negative_shape_id(desc_category, data="train")
-                neg_shape = self.train_data.shapes['data'][neg_id]
+    def __group_descriptions(self, description_index, shape_ids):
+        """
+        rows of all descriptions matching shape_ids
+        each modelId is added once --> primitives contain
+        multiple same shapes and we do not want to add
+        same description multiple times
+        """
 
-                triplet = TripletText2Shape(desc, pos_shape, neg_shape)
-                batch.append(triplet)
+        rows = []
+        remember_id = set()
+        for shape_id in shape_ids:
+            if shape_id not in remember_id:
+                rows.append(description_index.get(shape_id))
+                remember_id.add(shape_id)
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(rows)
 
-        return batch
+    def get_train_batch(self, version):
+        return self.__get_batch(version, data="train")
 
     def get_test_batch(self, version):
-        batch = []
-        if version == "s2t":
-            for _ in range(self.bs):
-                rand = np.random.randint(0, self.test_data.get_shape_length())
-                shape_id = self.test_data.shapes["modelId"][rand]
-                shape_category = self.test_data.shapes["category"][rand]
-                shape = self.test_data.shapes['data'][rand]
-
-                pos_id = self.__find_positive_description_id(
-                    shape_id, data="test")
-                # in case of no matching positive description is found
-                while pos_id == None:
-                    rand = np.random.randint(
-                        0, self.test_data.get_shape_length())
-                    shape_id = self.test_data.shapes["modelId"][rand]
-                    shape = self.test_data.shapes['data'][rand]
-
-                    pos_id = self.__find_positive_description_id(
-                        shape_id, data="test")
-
-                pos_desc = self.test_data.descriptions["description"][pos_id]
+        return self.__get_batch(version, data="test")
 
-                neg_id = self.__find_negative_description_id(
-                    shape_category, data="test")
-                neg_desc = self.test_data.descriptions["description"][neg_id]
+    def __get_data(self, data):
+        if data == "train":
+            return self.train_data
+        if data == "test":
+            return self.test_data
 
-                triplet = TripletShape2Text(shape, pos_desc, neg_desc)
+    def __get_batch(self, version, data):
+        """
+        draws all indices of a batch at once and gathers the data
+        with fancy indexing into contiguous [bs, ...] arrays
+        anchors are drawn from valid rows only
+        --> every anchor has at least one positive
+        """
 
-                batch.append(triplet)
-            return batch
+        data_loader = self.__get_data(data)
+        if version == "s2t":
+            valid = data_loader.valid_shapes
+            anchor_ids = valid[np.random.randint(0, len(valid), self.bs)]
+            pos_ids = data_loader.description_index.sample(
+                data_loader.shape_description_group[anchor_ids])
+            neg_ids = self.__find_negative_ids(
+                data_loader.shapes['category_code'][anchor_ids],
+                data_loader.description_category_index)
+
+            return TripletShape2Text(
+                data_loader.shapes['data'][anchor_ids],
+                data_loader.descriptions['description'][pos_ids],
+                data_loader.descriptions['description'][neg_ids])
 
         if version == "t2s":
-            for _ in range(self.bs):
-                rand = np.random.randint(
-                    0, self.test_data.get_description_length())
-                desc_id = self.test_data.descriptions["modelId"][rand]
-                desc_category = self.test_data.descriptions["category"][rand]
-                desc = self.test_data.descriptions['description'][rand]
-
-                pos_id = self.__find_positive_shape_id(
-                    desc_id, data="test")
-                # in case of no matching positive description is found
-                while pos_id == None:
-                    rand = np.random.randint(
-                        0, self.test_data.get_description_length())
-                    desc_id = self.test_data.descriptions["modelId"][rand]
-                    desc = self.test_data.descriptions['data'][rand]
-
-                    pos_id = self.__find_positive_shape_id(
-                        desc_id, data="test")
-
-                pos_shape = self.test_data.shapes["data"][pos_id]
-
-                neg_id = self.__find_negative_shape_id(
-                    desc_category, data="test")
-                neg_shape = self.test_data.shapes["data"][neg_id]
-
-                triplet = TripletText2Shape(desc, pos_shape, neg_shape)
-
-                batch.append(triplet)
-            return batch
-
-    def __find_positive_description_id(self, shape_id, data):
+            valid = data_loader.valid_descriptions
+            anchor_ids = valid[np.random.randint(0, len(valid), self.bs)]
+            pos_ids = data_loader.shape_index.sample(
+                data_loader.description_shape_group[anchor_ids])
+            neg_ids = self.__find_negative_ids(
+                data_loader.descriptions['category_code'][anchor_ids],
+                data_loader.shape_category_index)
+
+            return TripletText2Shape(
+                data_loader.descriptions['description'][anchor_ids],
+                data_loader.shapes['data'][pos_ids],
+                data_loader.shapes['data'][neg_ids])
+
+    def __find_negative_ids(self, anchor_categories, category_index):
         """
-        return random matching idx of all desciptions
+        random rows from category_index which belong to another category
+        than anchor_categories
         """
 
-        if data == "train":
-            matching_idx = [i for i, x in enumerate(
-                self.train_data.descriptions['modelId']) if x == shape_id]
-            if len(matching_idx) == 0:
-                return None
-            rand = np.random.randint(0, len(matching_idx))
-            return matching_idx[rand]
-        if data == "test":
-            matching_idx = [i for i, x in enumerate(
-                self.test_data.descriptions['modelId']) if x == shape_id]
-            if len(matching_idx) == 0:
-                return None
-            rand = np.random.randint(0, len(matching_idx))
-            return matching_idx[rand]
-
-    def __find_negative_description_id(self, shape_category, data):
-        if data == "train":
-            max_val = len(self.train_data.descriptions["modelId"])
-            rand = np.random.randint(0, max_val)
-            while self.train_data.descriptions["category"][rand] == shape_category:
-                rand = np.random.randint(0, max_val)
-            return rand
-        if data == "test":
-            max_val = len(self.test_data.descriptions["modelId"])
-            rand = np.random.randint(0, max_val)
-            while self.test_data.descriptions["category"][rand] == shape_category:
-                rand = np.random.randint(0, max_val)
-            return rand
-
-    def __find_positive_shape_id(self, desc_id, data):
-        if data == "train":
-            matching_idx = [i for i, x in enumerate(
-                self.train_data.shapes['modelId']) if x == desc_id]
-            if len(matching_idx) == 0:
-                return None
-            rand = np.random.randint(0, len(matching_idx))
-            return matching_idx[rand]
-        if data == "test":
-            matching_idx = [i for i, x in enumerate(
-                self.test_data.shapes['modelId']) if x == desc_id]
-            if len(matching_idx) == 0:
-                return None
-            rand = np.random.randint(0, len(matching_idx))
-            return matching_idx[rand]
-
-    def __find_negative_shape_id(self, desc_category, data):
-        if data == "train":
-            max_val = len(self.train_data.shapes["modelId"])
-            rand = np.random.randint(0, max_val)
-            while self.train_data.shapes["category"][rand] == desc_category:
-                rand = np.random.randint(0, max_val)
-            return rand
-        if data == "test":
-            max_val = len(self.test_data.shapes["modelId"])
-            rand = np.random.randint(0, max_val)
-            while self.test_data.shapes["category"][rand] == desc_category:
-                rand = np.random.randint(0, max_val)
-            return rand
+        groups = category_index.groups(anchor_categories)
+        return category_index.sample_complement(groups)
 
     def get_train_smart_batch(self, version):
         """
@@ -442,192 +633,72 @@ class TripletLoader(object):
         weighted according to frequency of word in selection
         """
 
-        randID = np.random.randint(
-            0, self.train_data.get_shape_length(), self.bs*self.oversample)
-        pos_descriptions = []
-
-        for i, index in enumerate(randID):
-            shape_id = self.train_data.shapes["modelId"][index]
-            pos_id = self.__find_positive_description_id(
-                shape_id, data="train")
-            # in case of no matching positive description is found
-            # workaround for descriptions without shape
-            while pos_id == None:
-                temp = np.random.randint(0, self.train_data.get_shape_length())
-                shape_id = self.train_data.shapes["modelId"][temp]
-                pos_id = self.__find_positive_description_id(
-                    shape_id, data="train")
-                randID[i] = temp
-            pos_descriptions.append(
-                self.train_data.descriptions["description"][pos_id])
-
-        # flattens list
-        all_pos_desc = [
-            item for sublist in pos_descriptions for item in sublist]
-        # remove all zeros
-        all_pos_desc = list(filter(lambda a: a != 0, all_pos_desc))
-        occurrences = collections.Counter(all_pos_desc)
-
-        scores = []
-        for description in pos_descriptions:
-            scores.append(self.comp_desc(
-                pos_descriptions[0], description, occurrences))
+        return self.__get_smart_batch(version, data="train")
 
-        sorted_idx = np.argsort(scores)[::-1]  # sort ascending order
-        self.selected_ids = np.array(randID)[sorted_idx[:self.bs]].tolist()
-
-        batch = []
-        if version == "s2t":
-            for index in self.selected_ids:
-                shape = self.train_data.shapes['data'][index]
-                shape_id = self.train_data.shapes["modelId"][index]
-                pos_id = self.__find_positive_description_id(
-                    shape_id, data="train")
-                pos_desc = self.train_data.descriptions["description"][pos_id]
-
-                neg_id = self.__find_smart_negative_description_id(
-                    shape_id, data="train")
-                neg_desc = self.train_data.descriptions["description"][neg_id]
-
-                triplet = TripletShape2Text(shape, pos_desc, neg_desc)
-                batch.append(triplet)
-
-            return batch
-
-        if version == "t2s":
-            for index in self.selected_ids:
-                pos_shape = self.train_data.shapes['data'][index]
-                shape_id = self.train_data.shapes["modelId"][index]
-                pos_id = self.__find_positive_description_id(
-                    shape_id, data="train")
-                desc = self.train_data.descriptions["description"][pos_id]
-
-                neg_id = self.__find_smart_negative_shape_id(
-                    shape_id, data="train")
-                neg_shape = self.train_data.shapes['data'][neg_id]
+    def get_test_smart_batch(self, version):
+        return self.__get_smart_batch(version, data="test")
 
-                triplet = TripletText2Shape(desc, pos_shape, neg_shape)
-                batch.append(triplet)
+    def __get_smart_batch(self, version, data):
+        """
+        selects bs shapes whose descriptions are closest to the first one
+        scores of all bs*oversample candidates are one sparse product
+        negatives are taken from the other selected (similar) shapes
+        keeps no state --> batches can be generated by several threads
+        """
 
-            return batch
+        data_loader = self.__get_data(data)
+        valid = data_loader.valid_shapes
+        randID = valid[np.random.randint(
+            0, len(valid), self.bs*self.oversample)]
+        pos_ids = data_loader.description_index.sample(
+            data_loader.shape_description_group[randID])
 
-    def get_test_smart_batch(self, version):
-        randID = np.random.randint(
-            0, self.test_data.get_shape_length(), self.bs*self.oversample)
-        pos_descriptions = []
-
-        for i, index in enumerate(randID):
-            shape_id = self.test_data.shapes["modelId"][index]
-            pos_id = self.__find_positive_description_id(shape_id, data="test")
-            # in case of no matching positive description is found
-            # workaround for descriptions without shape
-            while pos_id == None:
-                temp = np.random.randint(0, self.test_data.get_shape_length())
-                shape_id = self.test_data.shapes["modelId"][temp]
-                pos_id = self.__find_positive_description_id(
-                    shape_id, data="test")
-                randID[i] = temp
-            pos_descriptions.append(
-                self.test_data.descriptions["description"][pos_id])
-
-        # flattens list
-        all_pos_desc = [
-            item for sublist in pos_descriptions for item in sublist]
-        # remove all zeros
-        all_pos_desc = list(filter(lambda a: a != 0, all_pos_desc))
-        occurrences = collections.Counter(all_pos_desc)
-
-        scores = []
-        for description in pos_descriptions:
-            scores.append(self.comp_desc(
-                pos_descriptions[0], description, occurrences))
+        # score = sum of weights of all tokens shared with first description
+        #   weight = frequency of token within whole selection
+        counts = data_loader.bag_of_words[pos_ids]
+        occurrences = np.asarray(counts.sum(axis=0)).ravel()
+        weights = occurrences * (counts[0].toarray().ravel() > 0)
+        scores = counts.sign() @ weights
 
         sorted_idx = np.argsort(scores)[::-1]  # sort ascending order
-        self.selected_ids = np.array(randID)[sorted_idx[:self.bs]].tolist()
-
-        batch = []
-        if version == "s2t":
-            for index in self.selected_ids:
-                shape = self.test_data.shapes['data'][index]
-                shape_id = self.test_data.shapes["modelId"][index]
-                pos_id = self.__find_positive_description_id(
-                    shape_id, data="test")
-                pos_desc = self.test_data.descriptions["description"][pos_id]
-
-                neg_id = self.__find_smart_negative_description_id(
-                    shape_id, data="test")
-                neg_desc = self.test_data.descriptions["description"][neg_id]
+        selected = sorted_idx[:self.bs]
+        selected_ids = randID[selected]
+        selected_pos_ids = pos_ids[selected]
 
-                triplet = TripletShape2Text(shape, pos_desc, neg_desc)
-                batch.append(triplet)
+        neg = self.__find_smart_negative_ids(
+            data_loader.shape_description_group[selected_ids])
 
-            return batch
+        if version == "s2t":
+            return TripletShape2Text(
+                data_loader.shapes['data'][selected_ids],
+                data_loader.descriptions['description'][selected_pos_ids],
+                data_loader.descriptions['description'][selected_pos_ids[neg]])
 
         if version == "t2s":
-            for index in self.selected_ids:
-                pos_shape = self.test_data.shapes['data'][index]
-                shape_id = self.test_data.shapes["modelId"][index]
-                pos_id = self.__find_positive_description_id(
-                    shape_id, data="test")
-                desc = self.test_data.descriptions["description"][pos_id]
-
-                neg_id = self.__find_smart_negative_shape_id(
-                    shape_id, data="test")
-                neg_shape = self.test_data.shapes['data'][neg_id]
-
-                triplet = TripletText2Shape(desc, pos_shape, neg_shape)
-                batch.append(triplet)
-
-            return batch
-
-    def comp_desc(self, original, new, weights=None):
-        intersection = set(original).intersection(new)
+            return TripletText2Shape(
+                data_loader.descriptions['description'][selected_pos_ids],
+                data_loader.shapes['data'][selected_ids],
+                data_loader.shapes['data'][selected_ids[neg]])
 
-        if weights == None:
-            return len(intersection)
-        else:
-            weighted_matches = 0
-            for each in intersection:
-                weighted_matches += weights[each]
-            return weighted_matches
-
-    def __find_smart_negative_description_id(self, shape_id, data):
+    def __find_smart_negative_ids(self, groups, max_tries=10):
         """
-        return  matching idx of close descriptions
+        position within selected batch of another shape for each entry
+        entries with same modelId are drawn again (at most max_tries times)
         """
 
-        if data == "train":
-            rand = np.random.randint(0, self.bs)
-            index = self.selected_ids[rand]
-            while self.train_data.descriptions["modelId"][index] == shape_id:
-                rand = np.random.randint(0, self.bs)
-                index = self.selected_ids[rand]
-            return index
-        if data == "test":
-            rand = np.random.randint(0, self.bs)
-            index = self.selected_ids[rand]
-            while self.test_data.descriptions["modelId"][index] == shape_id:
-                rand = np.random.randint(0, self.bs)
-                index = self.selected_ids[rand]
-            return index
-
-    def __find_smart_negative_shape_id(self, shape_id, data):
-        if data == "train":
-            rand = np.random.randint(0, self.bs)
-            index = self.selected_ids[rand]
-            while self.train_data.shapes["modelId"][index] == shape_id:
-                rand = np.random.randint(0, self.bs)
-                index = self.selected_ids[rand]
-            return index
-
-        if data == "test":
-            rand = np.random.randint(0, self.bs)
-            index = self.selected_ids[rand]
-            while self.test_data.shapes["modelId"][index] == shape_id:
-                rand = np.random.randint(0, self.bs)
-                index = self.selected_ids[rand]
-            return rand
-
+        bs = len(groups)
+        position = np.arange(bs)
+        if bs < 2:
+            return position
+        neg = (position + np.random.randint(1, bs, bs)) % bs
+        same = groups[neg] == groups
+        for _ in range(max_tries):
+            if not same.any():
+                break
+            neg[same] = (position[same] +
+                         np.random.randint(1, bs, same.sum())) % bs
+            same = groups[neg] == groups
+        return neg
 
 class RetrievalLoader(DataLoader):
     """
@@ -641,80 +712,88 @@ class RetrievalLoader(DataLoader):
 
         self.txt_vectorization = loader.txt_vectorization
         self.length_voc = len(self.txt_vectorization.voc_list)
+        self.model_ids = loader.model_ids
+        self.categories = loader.categories
+        self.data_key = loader.data_key
 
 
-def parse_directory_for_nrrd(path):
-    shapes = dict()
-    shapes['modelId'] = []
-    shapes['data'] = []
-    i = 0
-    for root, _, files in os.walk(path):
-        for file in files:
-            if file.endswith(".nrrd"):
-                train_data, _ = nrrd.read(
-                    os.path.join(root, file), index_order='C')
-                shapes['modelId'].append(file.replace('.nrrd', ''))
-                shapes['data'].append(train_data)
-
-        print("parse directory {}".format(
-            i), end='\r')
-        i += 1
+def bag_of_words(description_matrix):
+    """
+    sparse [N, voc] matrix counting each token within each description
+    padding (0) is not counted
+    """
 
-    return shapes
+    n_desc, length = description_matrix.shape
+    tokens = np.asarray(description_matrix).ravel()
+    rows = np.repeat(np.arange(n_desc), length)
+    keep = tokens != 0
+    n_tokens = int(tokens.max()) + 1 if len(tokens) > 0 else 1
+
+    counts = scipy.sparse.csr_matrix(
+        (np.ones(keep.sum(), dtype=np.float32), (rows[keep], tokens[keep])),
+        shape=(n_desc, n_tokens))
+    counts.sum_duplicates()
+    return counts
 
 
-def parse_primitives(path, categorize):
+def read_description_columns(labels):
     """
-    generates needed form for training from
-    all files given in primitives directory
-    each folder contains:
-        10 shapes
-        between 20 and a few hunded descriptions
+    each column of captions csv as one numpy array
     """
 
+    descriptions = pd.read_csv(labels)
+    return {key: descriptions[key].to_numpy() for key in descriptions.columns}
+
+
+def encode_shared(values_a, values_b):
+    """
+    integer codes for two columns sharing one code book
+    returns code book, codes of values_a, codes of values_b
+    """
+
+    unique, codes = np.unique(np.concatenate([values_a, values_b]),
+                              return_inverse=True)
+    codes = codes.ravel().astype(np.int32)
+    return unique.tolist(), codes[:len(values_a)], codes[len(values_a):]
+
+
+def category_join(shape_ids, description_ids, description_categories,
+                  default="none"):
+    """
+    category for each shape id from the first description with same modelId
+    shapes without description get default
+    """
+
+    lookup = dict()
+    for model_id, category in zip(description_ids, description_categories):
+        lookup.setdefault(model_id, category)
+    return [lookup.get(model_id, default) for model_id in shape_ids]
+
+
+def parse_directory_for_nrrd(path, n_workers=1, shape_storage="dense",
+                             shape_cache_bytes=2**30):
+    """
+    reads all nrrd files within path into one preallocated uint8 array
+    n_workers > 1 reads the files with a process pool
+    shape_storage
+        sparse  keeps only occupied voxels (SparseShapes)
+        lazy    reads no file now, shapes are loaded on access (LazyShapes)
+    """
+
+    nrrd_files = find_nrrd_files(path)
+    files = [file for _, file in nrrd_files]
+
     shapes = dict()
-    shapes['modelId'] = []
-    shapes['data'] = []
-    shapes['category'] = []
-    descriptions = dict()
-    descriptions['modelId'] = []
-    descriptions['description'] = []
-    descriptions['category'] = []
-
-    for root, _, files in os.walk(path):
-        # used later to share descriptions between shapes
-        name_list = []
-        cat_list = []
-        desc_list = []
-        for file in files:
-            if file.endswith(".nrrd"):
-                name = file.replace(".nrrd", '')
-                name_list.append(name)
-                splitted = name.split("-")
-                if categorize == "shape_color":
-                    category = splitted[0] + " " + splitted[1]
-                if categorize == "shape":
-                    category = splitted[0]
-                    
-                cat_list.append(category)
-                train_data, _ = nrrd.read(
-                    os.path.join(root, file), index_order='C')
-                shapes['modelId'].append(name)
-                shapes['data'].append(train_data)
-                shapes['category'].append(category)
-
-            if file.endswith(".txt"):
-                # either too stupid or pandas suchs in this case
-                with open(os.path.join(root, file), newline='') as f:
-                    reader = csv.reader(f)
-                    desc_list = list(reader)
-        
-        # share the descriptions across shapes
-        if len(desc_list) != 0:
-            for desc in desc_list:
-                choice = np.random.randint(0, len(name_list))
-                descriptions['modelId'].append(name_list[choice])
-                descriptions['description'].append(desc[0])
-                descriptions['category'].append(cat_list[choice])
-
-    return shapes, descriptions
+    shapes['modelId'] = [model_id for model_id, _ in nrrd_files]
+    if shape_storage == "sparse":
+        shapes['data'] = SparseShapes.from_nrrd_files(files, n_workers)
+        return shapes
+    if shape_storage == "lazy":
+        shapes['data'] = LazyShapes.from_nrrd_files(files, shape_cache_bytes)
+        return shapes
+
+    first = read_nrrd(files[0])
+    shapes['data'] = np.empty((len(files),) + first.shape, dtype=np.uint8)
+    read_nrrd_files(files, shapes['data'], n_workers)
+
+    return shapes
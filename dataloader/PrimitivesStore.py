@@ -0,0 +1,197 @@
+import pandas as pd
+import numpy as np
+
+import os
+import csv
+import zlib
+import multiprocessing
+
+from dataloader.ShapeStore import PACKED_DATA, PACKED_INDEX, \
+    packed_shapes_exist, load_packed_shapes, read_nrrd, read_nrrd_files
+
+
+PACKED_DESCRIPTIONS = "descriptions.csv"
+
+
+def packed_primitives_exist(directory):
+    return packed_shapes_exist(directory) and \
+        os.path.isfile(os.path.join(directory, PACKED_DESCRIPTIONS))
+
+
+def primitive_category(model_id, categorize):
+    """
+    category from modelId "shape-color-..."
+        shape           shape
+        shape_color     shape color
+    """
+
+    splitted = model_id.split("-")
+    if categorize == "shape_color":
+        return splitted[0] + " " + splitted[1]
+    return splitted[0]
+
+
+def _parse_primitives_folder(job):
+    """
+    worker function - shapes and descriptions of one primitives folder
+    descriptions are shared across the shapes of the folder
+        random generator is seeded by folder name, files are sorted
+        --> same assignment in every run, process, machine and order
+            of folders
+    """
+
+    path, root, files, categorize = job
+    folder = dict(modelId=[], category=[], files=[],
+                  desc_modelId=[], description=[], desc_category=[])
+
+    desc_list = []
+    for file in files:
+        if file.endswith(".nrrd"):
+            name = file.replace(".nrrd", '')
+            folder['modelId'].append(name)
+            folder['category'].append(primitive_category(name, categorize))
+            folder['files'].append(os.path.join(root, file))
+
+        if file.endswith(".txt"):
+            # either too stupid or pandas suchs in this case
+            with open(os.path.join(root, file), newline='') as f:
+                reader = csv.reader(f)
+                desc_list = list(reader)
+
+    if len(desc_list) == 0 or len(folder['modelId']) == 0:
+        return folder
+
+    seed = zlib.crc32(os.path.relpath(root, path).encode())
+    choices = np.random.RandomState(seed).randint(
+        0, len(folder['modelId']), len(desc_list))
+    for desc, choice in zip(desc_list, choices):
+        folder['desc_modelId'].append(folder['modelId'][choice])
+        folder['description'].append(desc[0])
+        folder['desc_category'].append(folder['category'][choice])
+
+    return folder
+
+
+def _parse_primitives_folders(path, categorize, n_workers=1):
+    """
+    shapes and descriptions of all folders in sorted walk order
+    n_workers > 1 parses the folders with a process pool
+    """
+
+    # listing order depends on file system --> sorted folders and files
+    jobs = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        jobs.append((path, root, sorted(files), categorize))
+
+    if n_workers <= 1:
+        folders = [_parse_primitives_folder(job) for job in jobs]
+    else:
+        with multiprocessing.Pool(n_workers) as pool:
+            folders = pool.map(_parse_primitives_folder, jobs)
+
+    shapes = dict(modelId=[], category=[])
+    descriptions = dict(modelId=[], description=[], category=[])
+    nrrd_files = []
+    for folder in folders:
+        shapes['modelId'] += folder['modelId']
+        shapes['category'] += folder['category']
+        nrrd_files += folder['files']
+        descriptions['modelId'] += folder['desc_modelId']
+        descriptions['description'] += folder['description']
+        descriptions['category'] += folder['desc_category']
+
+    return shapes, descriptions, nrrd_files
+
+
+def parse_primitives(path, categorize, n_workers=1):
+    """
+    generates needed form for training from
+    all files given in primitives directory
+    each folder contains:
+        10 shapes
+        between 20 and a few hunded descriptions
+    shapes are collected first and read at once into one uint8 array
+    n_workers > 1 parses folders and reads nrrd files with a process pool
+    """
+
+    shapes, descriptions, nrrd_files = _parse_primitives_folders(
+        path, categorize, n_workers)
+
+    first = read_nrrd(nrrd_files[0])
+    shapes['data'] = np.empty(
+        (len(nrrd_files),) + first.shape, dtype=np.uint8)
+    read_nrrd_files(nrrd_files, shapes['data'], n_workers)
+
+    return shapes, descriptions
+
+
+def pack_primitives(path, categorize, directory, n_workers=1):
+    """
+    parses primitives once and saves them as packed dataset
+        PACKED_DATA         all shapes as one uint8 array
+        PACKED_INDEX        modelId of each shape
+        PACKED_DESCRIPTIONS modelId and description
+    categories are not saved --> one store for every categorize
+    """
+
+    shapes, descriptions, nrrd_files = _parse_primitives_folders(
+        path, categorize, n_workers)
+    if len(nrrd_files) == 0:
+        raise Exception("No nrrd files found in {}".format(path))
+
+    first = read_nrrd(nrrd_files[0])
+
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    # data is moved into place last --> store is never half written
+    data_file = os.path.join(directory, PACKED_DATA)
+    tmp_file = data_file + ".tmp"
+    data = np.lib.format.open_memmap(
+        tmp_file, mode='w+', dtype=np.uint8,
+        shape=(len(nrrd_files),) + first.shape)
+    read_nrrd_files(nrrd_files, data, n_workers)
+    data.flush()
+    del data
+
+    pd.DataFrame({'modelId': shapes['modelId']}).to_csv(
+        os.path.join(directory, PACKED_INDEX), index=False)
+    pd.DataFrame({key: descriptions[key] for key in
+                  ['modelId', 'description']}).to_csv(
+        os.path.join(directory, PACKED_DESCRIPTIONS), index=False)
+    os.replace(tmp_file, data_file)
+
+
+def load_packed_primitives(directory, categorize):
+    """
+    shapes are memory mapped, descriptions as lists like parse_primitives
+    categories are derived from modelId with the given categorize
+    """
+
+    shapes = load_packed_shapes(directory)
+    table = pd.read_csv(os.path.join(directory, PACKED_DESCRIPTIONS),
+                        usecols=['modelId', 'description'], dtype=str,
+                        keep_default_na=False)
+    descriptions = {key: table[key].tolist() for key in
+                    ['modelId', 'description']}
+    shapes['category'] = [primitive_category(model_id, categorize)
+                          for model_id in shapes['modelId']]
+    descriptions['category'] = [primitive_category(model_id, categorize)
+                                for model_id in descriptions['modelId']]
+    return shapes, descriptions
+
+
+def load_primitives(path, categorize, directory=None, n_workers=1):
+    """
+    packed dataset in directory is created at first call, later calls
+    only load it --> same shapes and descriptions for every user
+    without directory primitives are parsed again
+    """
+
+    if directory is None:
+        return parse_primitives(path, categorize, n_workers)
+    if not packed_primitives_exist(directory):
+        print("...packing primitives into {}".format(directory))
+        pack_primitives(path, categorize, directory, n_workers)
+    return load_packed_primitives(directory, categorize)
@@ -0,0 +1,401 @@
+import nrrd
+import pandas as pd
+import numpy as np
+
+import os
+import collections
+import threading
+import multiprocessing
+
+
+PACKED_DATA = "shapes.npy"
+PACKED_INDEX = "index.csv"
+SPARSE_META = "sparse.npz"
+SPARSE_ARRAYS = ["voxels", "values", "offsets"]
+
+
+def packed_shapes_exist(directory):
+    return os.path.isfile(os.path.join(directory, PACKED_DATA)) and \
+        os.path.isfile(os.path.join(directory, PACKED_INDEX))
+
+
+def find_nrrd_files(path):
+    """
+    walks directory and returns list of (modelId, file) tuples
+    same order as parse_directory_for_nrrd so packed and unpacked
+    data end up in the same train/test split
+    """
+
+    nrrd_files = []
+    for root, _, files in os.walk(path):
+        for file in files:
+            if file.endswith(".nrrd"):
+                nrrd_files.append((file.replace('.nrrd', ''),
+                                   os.path.join(root, file)))
+    return nrrd_files
+
+
+def read_nrrd(file):
+    data, _ = nrrd.read(file, index_order='C')
+    return data
+
+
+def _read_nrrd_chunk(job):
+    """
+    worker function - reads consecutive files and returns them as one block
+    so only one array per chunk is send back to the main process
+    """
+
+    start, files = job
+    return start, np.stack([read_nrrd(file) for file in files])
+
+
+def iter_nrrd_chunks(files, n_workers=1, chunk_size=64):
+    """
+    yields (start, block) in order of files
+        block holds the stacked shapes of files[start:start + len(block)]
+        n_workers > 1 spreads nrrd.read over a process pool
+    """
+
+    jobs = [(start, files[start:start + chunk_size])
+            for start in range(0, len(files), chunk_size)]
+
+    if n_workers <= 1:
+        for job in jobs:
+            yield _read_nrrd_chunk(job)
+        return
+
+    with multiprocessing.Pool(n_workers) as pool:
+        for start, block in pool.imap(_read_nrrd_chunk, jobs):
+            yield start, block
+
+
+def read_nrrd_files(files, out, n_workers=1, chunk_size=64):
+    """
+    reads all files into preallocated out (array or memory map)
+        row i of out belongs to files[i]
+        results stream back in chunks of chunk_size files
+    """
+
+    for start, block in iter_nrrd_chunks(files, n_workers, chunk_size):
+        out[start:start + len(block)] = block
+        print("read shape {} of {}".format(
+            start + len(block), len(files)), end='\r')
+    print()
+    return out
+
+
+class SparseShapes(object):
+    """
+    stores only occupied voxels (any channel != 0) of all shapes
+        voxels      flat position of each occupied voxel within the grid
+        values      rgba of each occupied voxel
+        offsets     voxels of shape i are voxels[offsets[i]:offsets[i+1]]
+    behaves like the dense [N, 32, 32, 32, 4] array
+        data[i]         dense shape
+        data[rows]      dense batch [len(rows), 32, 32, 32, 4]
+        data[a:b]       sparse view on shapes a to b
+    """
+
+    def __init__(self, voxels, values, offsets, grid_shape, rows=None):
+        self.voxels = voxels
+        self.values = values
+        self.offsets = offsets
+        self.grid_shape = tuple(grid_shape)
+        if rows is None:
+            rows = np.arange(len(offsets) - 1)
+        self.rows = rows
+
+    @classmethod
+    def from_chunks(cls, chunks, grid_shape):
+        """
+        builds sparse storage from dense blocks [n, 32, 32, 32, 4]
+        only one block is dense in memory at a time
+        """
+
+        grid_shape = tuple(grid_shape)
+        n_voxels = int(np.prod(grid_shape[:-1]))
+        voxel_dtype = np.uint16 if n_voxels <= 2**16 else np.uint32
+
+        voxels = []
+        values = []
+        counts = []
+        for block in chunks:
+            flat = np.asarray(block).reshape(len(block), n_voxels, -1)
+            occupied = flat.any(axis=2)
+            _, voxel = np.nonzero(occupied)
+            voxels.append(voxel.astype(voxel_dtype))
+            values.append(flat[occupied].astype(np.uint8))
+            counts.append(occupied.sum(axis=1))
+
+        counts = np.concatenate(counts)
+        offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        return cls(np.concatenate(voxels), np.concatenate(values), offsets,
+                   grid_shape)
+
+    @classmethod
+    def from_dense(cls, data, chunk_size=256):
+        chunks = (data[start:start + chunk_size]
+                  for start in range(0, len(data), chunk_size))
+        return cls.from_chunks(chunks, data.shape[1:])
+
+    @classmethod
+    def from_nrrd_files(cls, files, n_workers=1, chunk_size=64):
+        first = read_nrrd(files[0])
+        chunks = (block for _, block in
+                  iter_nrrd_chunks(files, n_workers, chunk_size))
+        return cls.from_chunks(chunks, first.shape)
+
+    @property
+    def shape(self):
+        return (len(self.rows),) + self.grid_shape
+
+    @property
+    def nbytes(self):
+        return self.voxels.nbytes + self.values.nbytes + self.offsets.nbytes
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return SparseShapes(self.voxels, self.values, self.offsets,
+                                self.grid_shape, self.rows[item])
+        if np.ndim(item) == 0:
+            return self.densify(self.rows[[item]])[0]
+        return self.densify(self.rows[np.asarray(item)])
+
+    def densify(self, rows):
+        """
+        dense uint8 [len(rows), 32, 32, 32, 4] for given base rows
+        """
+
+        n_voxels = int(np.prod(self.grid_shape[:-1]))
+        start = self.offsets[rows]
+        counts = self.offsets[rows + 1] - start
+
+        # position of each needed voxel within voxels/values
+        ends = np.cumsum(counts)
+        position = np.arange(ends[-1] if len(ends) > 0 else 0) + \
+            np.repeat(start - (ends - counts), counts)
+        batch = np.repeat(np.arange(len(rows)), counts)
+
+        dense = np.zeros((len(rows), n_voxels, self.grid_shape[-1]),
+                         dtype=np.uint8)
+        dense[batch, self.voxels[position]] = self.values[position]
+        return dense.reshape((len(rows),) + self.grid_shape)
+
+
+class ShapeCache(object):
+    """
+    bounded LRU cache for shapes loaded on demand
+        load        function row --> uint8 shape
+        capacity    max bytes of all cached shapes
+    thread safe --> can be shared by prefetching workers
+    """
+
+    def __init__(self, load, capacity):
+        self.load = load
+        self.capacity = capacity
+        self.cache = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, row):
+        with self.lock:
+            shape = self.cache.get(row)
+            if shape is not None:
+                self.cache.move_to_end(row)
+                self.hits += 1
+                return shape
+            self.misses += 1
+
+        # load outside of lock so several workers can read from disk
+        shape = np.asarray(self.load(row), dtype=np.uint8)
+
+        with self.lock:
+            if row not in self.cache and shape.nbytes <= self.capacity:
+                self.cache[row] = shape
+                self.size += shape.nbytes
+                while self.size > self.capacity:
+                    _, old = self.cache.popitem(last=False)
+                    self.size -= old.nbytes
+        return shape
+
+    def info(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": self.size, "capacity": self.capacity,
+                    "entries": len(self.cache)}
+
+
+class LazyShapes(object):
+    """
+    shapes are loaded from disk only when they are accessed
+        either from nrrd files or from a packed memory map
+        loaded shapes are kept in a ShapeCache of capacity bytes
+    behaves like the dense [N, 32, 32, 32, 4] array
+        data[i]         dense shape
+        data[rows]      dense batch [len(rows), 32, 32, 32, 4]
+        data[a:b]       lazy view on shapes a to b, sharing the cache
+    """
+
+    def __init__(self, cache, grid_shape, rows):
+        self.cache = cache
+        self.grid_shape = tuple(grid_shape)
+        self.rows = rows
+
+    @classmethod
+    def from_nrrd_files(cls, files, capacity):
+        first = read_nrrd(files[0])
+        cache = ShapeCache(lambda row: read_nrrd(files[row]), capacity)
+        return cls(cache, first.shape, np.arange(len(files)))
+
+    @classmethod
+    def from_array(cls, data, capacity):
+        # np.array copies the row out of the memory map
+        cache = ShapeCache(lambda row: np.array(data[row]), capacity)
+        return cls(cache, data.shape[1:], np.arange(len(data)))
+
+    @property
+    def shape(self):
+        return (len(self.rows),) + self.grid_shape
+
+    def cache_info(self):
+        return self.cache.info()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return LazyShapes(self.cache, self.grid_shape, self.rows[item])
+        if np.ndim(item) == 0:
+            return self.cache.get(int(self.rows[item]))
+        rows = self.rows[np.asarray(item)]
+        batch = np.empty((len(rows),) + self.grid_shape, dtype=np.uint8)
+        for i, row in enumerate(rows):
+            batch[i] = self.cache.get(int(row))
+        return batch
+
+
+def pack_nrrd_directory(path, directory, n_workers=1):
+    """
+    one time step which reads all nrrd files given in path and writes them
+    into one contiguous uint8 array (PACKED_DATA) plus index (PACKED_INDEX)
+        row i of the array belongs to row i of the index
+        index holds only modelId, category is joined from the labels on load
+        n_workers processes read the nrrd files in parallel
+    """
+
+    nrrd_files = find_nrrd_files(path)
+    if len(nrrd_files) == 0:
+        raise Exception("No nrrd files found in {}".format(path))
+
+    # first shape defines resolution of the packed store
+    first = read_nrrd(nrrd_files[0][1])
+
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    # write into temporary file first so a crashed run never leaves
+    # a half written store behind that looks complete
+    data_file = os.path.join(directory, PACKED_DATA)
+    tmp_file = data_file + ".tmp"
+    data = np.lib.format.open_memmap(
+        tmp_file, mode='w+', dtype=np.uint8,
+        shape=(len(nrrd_files),) + first.shape)
+
+    read_nrrd_files([file for _, file in nrrd_files], data, n_workers)
+
+    data.flush()
+    del data
+
+    model_ids = [model_id for model_id, _ in nrrd_files]
+    index = pd.DataFrame({'modelId': model_ids})
+    index.to_csv(os.path.join(directory, PACKED_INDEX), index=False)
+    os.replace(tmp_file, data_file)
+
+
+def load_packed_shapes(directory):
+    """
+    opens packed store as memory map
+    only the rows which are accessed are read from disk
+    """
+
+    # stores of older versions may hold a category column, which is ignored
+    index = pd.read_csv(os.path.join(directory, PACKED_INDEX),
+                        usecols=['modelId'], dtype={'modelId': str},
+                        keep_default_na=False)
+
+    shapes = dict()
+    shapes['modelId'] = index['modelId'].tolist()
+    shapes['data'] = load_packed_data(directory)
+
+    if len(shapes['modelId']) != shapes['data'].shape[0]:
+        raise Exception(
+            "Packed store {} is corrupted - index does not match data".format(directory))
+
+    return shapes
+
+
+def save_packed_data(directory, data):
+    """
+    writes shapes already in memory as PACKED_DATA into directory
+    """
+
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    data_file = os.path.join(directory, PACKED_DATA)
+    # np.save appends .npy to names without it
+    tmp_file = data_file[:-len(".npy")] + ".tmp.npy"
+    np.save(tmp_file, np.ascontiguousarray(data, dtype=np.uint8))
+    os.replace(tmp_file, data_file)
+
+
+def load_packed_data(directory):
+    return np.load(os.path.join(directory, PACKED_DATA), mmap_mode='r')
+
+
+def _packed_data_key(directory):
+    stat = os.stat(os.path.join(directory, PACKED_DATA))
+    return "{}-{}".format(stat.st_size, stat.st_mtime_ns)
+
+
+def save_sparse_shapes(directory, shapes):
+    """
+    writes voxels, values and offsets of SparseShapes next to PACKED_DATA
+    SPARSE_META (key of PACKED_DATA and grid shape) is written last
+    --> sparse arrays only match the packed data they are build from
+    """
+
+    for name in SPARSE_ARRAYS:
+        file_name = os.path.join(directory, "sparse_{}.npy".format(name))
+        tmp_file = file_name[:-len(".npy")] + ".tmp.npy"
+        np.save(tmp_file, getattr(shapes, name))
+        os.replace(tmp_file, file_name)
+    meta_file = os.path.join(directory, SPARSE_META)
+    tmp_file = meta_file[:-len(".npz")] + ".tmp.npz"
+    np.savez(tmp_file, key=np.array(_packed_data_key(directory)),
+             grid_shape=np.asarray(shapes.grid_shape))
+    os.replace(tmp_file, meta_file)
+
+
+def load_sparse_shapes(directory):
+    """
+    reopens saved SparseShapes as memory maps
+    returns None if nothing is saved or PACKED_DATA changed since
+    """
+
+    meta_file = os.path.join(directory, SPARSE_META)
+    if not os.path.isfile(meta_file):
+        return None
+    with np.load(meta_file) as meta:
+        if str(meta['key']) != _packed_data_key(directory):
+            return None
+        grid_shape = tuple(meta['grid_shape'])
+    arrays = [np.load(os.path.join(directory, "sparse_{}.npy".format(name)),
+                      mmap_mode='r') for name in SPARSE_ARRAYS]
+    return SparseShapes(*arrays, grid_shape)
@@ -17,26 +17,65 @@ class TxtVectorization(object):
             for key, value in voc_dict.items():
                 self.voc_list.append(value)
 
+            # id --> word and id --> is END as arrays for batch decoding
+            self.voc_array = np.array(self.voc_list, dtype=object)
+            self.end_ids = self.voc_array == "END"
+
+            # first occurrence wins, same as voc_list.index
+            self.word2id = dict()
+            for i, word in enumerate(self.voc_list):
+                self.word2id.setdefault(word, i)
+
         except:
             sys.exit("ERROR! TxtVectorization is not able to read csv file")
 
     def description2vector(self, description):
-        words = description.split(" ")
-        vector = np.zeros(self.max_desc_length, dtype=np.int32)
-        for i, word in enumerate(words):
-            if word in self.voc_list:
-                vector[i] = self.voc_list.index(word)
-            else:
-                vector[i] = self.voc_list.index("UNK")
-        return vector
+        return self.descriptions2matrix([description])[0]
+
+    def descriptions2matrix(self, descriptions):
+        """
+        codes all descriptions at once into one [N, max_desc_length] matrix
+            words after max_desc_length are cut off
+            words not within vocabulary are coded as UNK
+        """
+
+        lengths = np.zeros(len(descriptions), dtype=np.int64)
+        words = []
+        for i, description in enumerate(descriptions):
+            splitted = description.split(" ")[:self.max_desc_length]
+            lengths[i] = len(splitted)
+            words += splitted
+
+        get = self.word2id.get
+        ids = np.fromiter((get(word, -1) for word in words),
+                          dtype=np.int32, count=len(words))
+        unknown = ids < 0
+        if unknown.any():
+            ids[unknown] = self.word2id["UNK"]
+
+        # column of each word within its description
+        starts = np.cumsum(lengths) - lengths
+        rows = np.repeat(np.arange(len(descriptions)), lengths)
+        columns = np.arange(len(words)) - np.repeat(starts, lengths)
+
+        matrix = np.zeros((len(descriptions), self.max_desc_length),
+                          dtype=np.int32)
+        matrix[rows, columns] = ids
+        return matrix
 
     def vector2description(self, vector):
-        description = ""
-        for i in range(len(vector)):
-            word = self.voc_list[vector[i]]
-            if word == "END":
-                break
-            description += word + " "
-        # remove last space
-        description = description[:-1]
-        return description
\ No newline at end of file
+        return self.matrix2descriptions(np.reshape(vector, (1, -1)))[0]
+
+    def matrix2descriptions(self, matrix):
+        """
+        decodes all rows of a [k, max_desc_length] matrix at once
+        each description ends before first END token
+        """
+
+        matrix = np.asarray(matrix)
+        is_end = self.end_ids[matrix]
+        # rows without END keep all words
+        lengths = np.where(is_end.any(axis=1), is_end.argmax(axis=1),
+                           matrix.shape[1])
+        words = self.voc_array[matrix[:, :lengths.max(initial=0)]]
+        return [" ".join(row[:length]) for row, length in zip(words, lengths)]
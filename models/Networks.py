@@ -7,6 +7,7 @@ class ShapeEncoder(nn.Module):
     Network for shape encoder
     Conv3d --> 	[batch_size, in_channels (RGB+alpha), depth, height, width]
                 [bs, 4, 32, 32, 32]
+    input is expected as uint8 [bs, 32, 32, 32, 4]
     """
     def __init__(self):
         super(ShapeEncoder, self).__init__()
@@ -23,8 +24,10 @@ class ShapeEncoder(nn.Module):
     def forward(self, x):
         # bring shape [bs, depth, height, widt, rgb+a]
         # to shape [bs, rgb+a, depth, height, width]
+        # shapes are stored as uint8 and converted to float only here
+        # values stay within 0..255 so trained models remain valid
         
-        x = x.permute(0, 4, 1, 2, 3)
+        x = x.permute(0, 4, 1, 2, 3).float()
         x = F.relu(self.conv1(x))
         x = F.relu(self.conv2(x))
         x = F.relu(self.conv3(x))
@@ -36,9 +36,8 @@ class TripletEncoder(object):
 
     def update(self, batch, batch_2=0):
         '''
-        how does the batch looks like???
-        so far:
-            batch is list of class Triplet
+        batch is TripletShape2Text or TripletText2Shape
+        holding [bs, ...] arrays
         batch_2 != 0:
             one batch t2s and another batch s2t and same time
         '''
@@ -144,39 +143,31 @@ class TripletEncoder(object):
             sys.exit("ERROR! Failed loading models into TripletEncoder")
 
     def __forward_batch(self, batch):
-        if isinstance(batch[0], TripletShape2Text):
-            shape_batch, pos_desc_batch, neg_desc_batch = self.triplet_list_to_tensor(
+        if isinstance(batch, TripletShape2Text):
+            shape_batch, pos_desc_batch, neg_desc_batch = self.triplet_to_tensor(
                 batch)
-            # set requires_grad to true
-            shape_batch.requires_grad_()
             pos = self.text_encoder(pos_desc_batch)
             neg = self.text_encoder(neg_desc_batch)
             anchor = self.shape_encoder(shape_batch)
 
-        if isinstance(batch[0], TripletText2Shape):
-            desc_batch, pos_shape_batch, neg_shape_batch = self.triplet_list_to_tensor(
+        if isinstance(batch, TripletText2Shape):
+            desc_batch, pos_shape_batch, neg_shape_batch = self.triplet_to_tensor(
                 batch)
-            pos_shape_batch.requires_grad_()
-            neg_shape_batch.requires_grad_()
             pos = self.shape_encoder(pos_shape_batch)
             neg = self.shape_encoder(neg_shape_batch)
             anchor = self.text_encoder(desc_batch)
         return anchor, pos, neg
 
-    def triplet_list_to_tensor(self, batch):
+    def triplet_to_tensor(self, batch):
         '''
-        triplet list get seperatet into tree tensors
+        batch holds contiguous [bs, ...] arrays
+        --> wrapped without copy and moved to device
+        shapes stay uint8, ShapeEncoder converts them to float
         '''
-        if isinstance(batch[0], TripletShape2Text):
-            bs = len(batch)
-            max_length = 96
-            pos_desc_batch = torch.zeros((bs, max_length)).long()
-            neg_desc_batch = torch.zeros((bs, max_length)).long()
-            shape_batch = torch.zeros((bs, 32, 32, 32, 4))
-            for i, triplet in enumerate(batch):
-                pos_desc_batch[i] = torch.from_numpy(triplet.pos_desc).long()
-                neg_desc_batch[i] = torch.from_numpy(triplet.neg_desc).long()
-                shape_batch[i] = torch.from_numpy(triplet.shape)
+        if isinstance(batch, TripletShape2Text):
+            shape_batch = torch.from_numpy(batch.shape)
+            pos_desc_batch = torch.from_numpy(batch.pos_desc).long()
+            neg_desc_batch = torch.from_numpy(batch.neg_desc).long()
 
             shape_batch = shape_batch.to(self.device)
             pos_desc_batch = pos_desc_batch.to(self.device)
@@ -184,16 +175,10 @@ class TripletEncoder(object):
 
             return shape_batch, pos_desc_batch, neg_desc_batch
         
-        if isinstance(batch[0], TripletText2Shape):
-            bs = len(batch)
-            max_length = 96
-            pos_shape_batch = torch.zeros((bs, 32, 32, 32, 4))
-            neg_shape_batch = torch.zeros((bs, 32, 32, 32, 4))
-            desc_batch = torch.zeros((bs, max_length)).long()
-            for i, triplet in enumerate(batch):
-                pos_shape_batch[i] = torch.from_numpy(triplet.pos_shape)
-                neg_shape_batch[i] = torch.from_numpy(triplet.neg_shape)
-                desc_batch[i] = torch.from_numpy(triplet.desc)
+        if isinstance(batch, TripletText2Shape):
+            desc_batch = torch.from_numpy(batch.desc).long()
+            pos_shape_batch = torch.from_numpy(batch.pos_shape)
+            neg_shape_batch = torch.from_numpy(batch.neg_shape)
             
             pos_shape_batch = pos_shape_batch.to(self.device)
             neg_shape_batch = neg_shape_batch.to(self.device)
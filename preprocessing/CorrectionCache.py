@@ -0,0 +1,62 @@
+import hashlib
+import sqlite3
+
+
+class CorrectionCache(object):
+    '''
+    grammar corrections of captions, optionally saved in sqlite file
+        key         sha1 of caption
+        correct     function caption --> corrected caption
+    each caption is corrected once, duplicates within one run and captions
+    of earlier runs (same file) are taken from the cache
+    '''
+
+    def __init__(self, correct, file_name=None, commit_every=1000):
+        self.correct = correct
+        self.memory = dict()
+        self.hits = 0
+        self.misses = 0
+        self.commit_every = commit_every
+        self.pending = 0
+        self.connection = None
+        if file_name is not None:
+            # spacy may pull captions from another thread
+            self.connection = sqlite3.connect(file_name,
+                                              check_same_thread=False)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS corrections "
+                "(key TEXT PRIMARY KEY, corrected TEXT NOT NULL)")
+
+    def __call__(self, caption):
+        key = hashlib.sha1(caption.encode()).hexdigest()
+
+        corrected = self.memory.get(key)
+        if corrected is None and self.connection is not None:
+            row = self.connection.execute(
+                "SELECT corrected FROM corrections WHERE key = ?",
+                (key,)).fetchone()
+            if row is not None:
+                corrected = row[0]
+                self.memory[key] = corrected
+        if corrected is not None:
+            self.hits += 1
+            return corrected
+
+        self.misses += 1
+        corrected = self.correct(caption)
+        self.memory[key] = corrected
+        if self.connection is not None:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO corrections VALUES (?, ?)",
+                (key, corrected))
+            self.pending += 1
+            if self.pending >= self.commit_every:
+                self.connection.commit()
+                self.pending = 0
+        return corrected
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.commit()
+            self.connection.close()
+            self.connection = None
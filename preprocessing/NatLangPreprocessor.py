@@ -3,6 +3,12 @@ import pandas as pd
 import spacy
 import language_tool_python
 import sys
+import os
+import json
+import collections
+
+from CorrectionCache import CorrectionCache
+from VocabularyBuilder import build_vocabulary, save_vocabulary
 
 
 class NatLangPreprocessor():
@@ -11,72 +17,234 @@ class NatLangPreprocessor():
     - saves vorabulary with all words which appear more than twice
     - saves preprocessed data with form "the table is red . the table is round"
       each word within description can be saved to list with space as delimitter
+    - grammar corrections are cached, optionally within sqlite file
+      correction_cache --> language tool only started for unseen captions
+    - stream --> csv is read in chunks by preprocess_stream and appended
+      to the output, interrupted runs are resumed
     '''
-    def __init__(self, csv_dir):
-        if type(csv_dir == dict):
+    def __init__(self, csv_dir, correction_cache=None, stream=False):
+        self.csv_dir = csv_dir
+        if isinstance(csv_dir, dict):
             self.csv_data = csv_dir
         else:
             try:
-                self.csv_data = pd.read_csv(csv_dir)
+                # streaming reads just the header here
+                self.csv_data = pd.read_csv(
+                    csv_dir, nrows=0 if stream else None)
             except:
                 sys.exit("ERROR! Preprocessor is not able to read csv file")
 
         self.prep_data = dict()
-        self.unique_tokens = dict()
+        self.unique_tokens = collections.Counter()
         for key in self.csv_data.keys():
             self.prep_data.update({key: []})
-        self.tool = language_tool_python.LanguageTool('en-US')
+        self.tool = None
+        self.nlp = None
+        self.correction_cache = CorrectionCache(self._correct, correction_cache)
+
+    def _correct(self, description):
+        # starting language tool takes long --> only if needed
+        if self.tool is None:
+            self.tool = language_tool_python.LanguageTool('en-US')
+        return self.tool.correct(description)
+
+    def _load_nlp(self):
+        # only token.norm_ is used --> parser and ner are disabled
+        if self.nlp is None:
+            self.nlp = spacy.load("en_core_web_sm", disable=["parser", "ner"])
+        return self.nlp
+
+    def _process(self, descriptions, n_process=1, batch_size=256):
+        """
+        yields (i, word list) for each description which is a string
+        corrected descriptions are streamed in batches through spacy
+            n_process       processes running the spacy pipeline
+            batch_size      descriptions per batch
+        only token.norm_ is used --> parser and ner are disabled
+        """
+
+        rows = [(i, description) for i, description in enumerate(descriptions)
+                if type(description) == str]
+        corrected = (self.correction_cache(description)
+                     for _, description in rows)
+        docs = self._load_nlp().pipe(corrected, n_process=n_process,
+                                     batch_size=batch_size)
+
+        for (i, _), doc in zip(rows, docs):
+            # TODO might be lemma_ however returns PRON sometimes i.e. for it
+            yield i, [token.norm_ for token in doc]
+
+    def _close_correction_cache(self):
+        self.correction_cache.close()
+        print("Corrections: {} from cache, {} by language tool".format(
+            self.correction_cache.hits, self.correction_cache.misses))
+
+    def preprocess(self, max_length=96, n_process=1, batch_size=256):
+        """
+        processes all descriptions in memory
+        returns number of processed descriptions
+        """
 
-    def preprocess(self, max_length=96):
-        nlp = spacy.load("en_core_web_sm")
         length = len(self.csv_data['description'])
-        for i, description in enumerate(self.csv_data['description']):
-            if type(description) == str:
-                description_check_locs = self.tool.correct(description)
-                doc = nlp(description_check_locs)
-                preprocessed_description = ""
-                word_list = []
-                for token in doc:
-                    # TODO might be lemma_ however returns PRON sometimes i.e. for it
-                    preprocessed_description += token.norm_ + " "
-                    word_list.append(token.norm_)
-                # remove last space
-                preprocessed_description = preprocessed_description[:-1]
-                self._count(word_list)
-                if len(word_list) < max_length:
-                    for key in self.csv_data.keys():
-                        if key == 'description':
-                            self.prep_data['description'].append(
-                                preprocessed_description)
-                        else:
-                            self.prep_data[key].append(self.csv_data[key][i])
+        n_processed = 0
+        for i, word_list in self._process(
+                self.csv_data['description'], n_process, batch_size):
+            n_processed += 1
+            self._count(word_list)
+            if len(word_list) < max_length:
+                for key in self.csv_data.keys():
+                    if key == 'description':
+                        self.prep_data['description'].append(
+                            " ".join(word_list))
+                    else:
+                        self.prep_data[key].append(self.csv_data[key][i])
             print('Preprocessing text {:.2f} %'.format(i/length*100), end='\r')
+        print()
+
+        self._close_correction_cache()
+        return n_processed
+
+    def preprocess_stream(self, output_csv, chunk_size=10000, max_length=96,
+                          n_process=1, batch_size=256):
+        """
+        reads csv in chunks and appends each processed chunk to output_csv
+        all chunks go through one spacy pipe (workers are started once)
+        checkpoint (output_csv + .checkpoint) is written after each chunk
+            size of output file and token counts so far
+            ids of processed rows which are not saved (too long, no string)
+            output rows written after last checkpoint are cut off on resume
+        rows whose id is already within output_csv or checkpoint are skipped
+            --> interrupted runs resume, new captions are added incrementally
+        returns number of processed descriptions
+        """
+
+        if 'id' not in self.csv_data.keys():
+            sys.exit("ERROR! Preprocessor needs id column for streaming")
+
+        checkpoint_file = output_csv + ".checkpoint"
+        self.dropped_ids = []
+        done_ids = self._resume(output_csv, checkpoint_file)
+        if len(done_ids) > 0:
+            print("...resuming, {} rows already processed".format(
+                len(done_ids)))
+
+        # one spacy pipe over all chunks --> worker processes start once
+        # chunk and row travel with each description (as_tuples)
+        pending = collections.deque()
+
+        def descriptions():
+            n_read = 0
+            for chunk in pd.read_csv(self.csv_dir, chunksize=chunk_size):
+                n_read += len(chunk)
+                chunk = chunk[~chunk['id'].isin(done_ids)]
+                if len(chunk) == 0:
+                    continue
+                rows = [i for i, description in
+                        enumerate(chunk['description'].tolist())
+                        if type(description) == str]
+                entry = dict(chunk=chunk, n_read=n_read, expected=len(rows),
+                             done=0, keep=[], preprocessed=[])
+                pending.append(entry)
+                for i in rows:
+                    yield self.correction_cache(
+                        chunk['description'].iloc[i]), (entry, i)
+
+        docs = self._load_nlp().pipe(descriptions(), as_tuples=True,
+                                     n_process=n_process,
+                                     batch_size=batch_size)
+        n_processed = 0
+        for doc, (entry, i) in docs:
+            word_list = [token.norm_ for token in doc]
+            n_processed += 1
+            self._count(word_list)
+            if len(word_list) < max_length:
+                entry['keep'].append(i)
+                entry['preprocessed'].append(" ".join(word_list))
+            entry['done'] += 1
+
+            # docs come in order --> finished chunks are at the front
+            while len(pending) > 0 and \
+                    pending[0]['done'] == pending[0]['expected']:
+                self._write_chunk(pending.popleft(), output_csv,
+                                  checkpoint_file, n_processed)
+        # chunks without any string description
+        while len(pending) > 0:
+            self._write_chunk(pending.popleft(), output_csv, checkpoint_file,
+                              n_processed)
+        print()
+
+        self._close_correction_cache()
+        return n_processed
+
+    def _write_chunk(self, entry, output_csv, checkpoint_file, n_processed):
+        """
+        appends kept rows of a finished chunk and writes checkpoint
+        """
+
+        chunk = entry['chunk']
+        dropped = np.ones(len(chunk), dtype=bool)
+        dropped[entry['keep']] = False
+        self.dropped_ids.extend(chunk['id'][dropped].tolist())
+
+        processed = chunk.iloc[entry['keep']].copy()
+        processed['description'] = entry['preprocessed']
+        processed.to_csv(output_csv, mode='a', index=False,
+                         header=not os.path.isfile(output_csv))
+        self._save_checkpoint(output_csv, checkpoint_file)
+        print('Preprocessing text: {} rows read, {} processed'.format(
+            entry['n_read'], n_processed), end='\r')
+
+    def _resume(self, output_csv, checkpoint_file):
+        """
+        restores token counts and dropped ids
+        returns ids already within output_csv or dropped before
+        """
+
+        if not os.path.isfile(output_csv):
+            return set()
+
+        if os.path.isfile(checkpoint_file):
+            with open(checkpoint_file) as f:
+                checkpoint = json.load(f)
+            self.unique_tokens = collections.Counter(
+                checkpoint['unique_tokens'])
+            self.dropped_ids = checkpoint.get('dropped_ids', [])
+            # rows appended after last checkpoint are not counted
+            if os.path.getsize(output_csv) > checkpoint['output_bytes']:
+                with open(output_csv, 'r+b') as f:
+                    f.truncate(checkpoint['output_bytes'])
+        else:
+            # output of an older run - counts are rebuild from saved rows
+            # (descriptions longer than max_length are missing there)
+            print("...no checkpoint, counting tokens of {}".format(output_csv))
+            output = pd.read_csv(output_csv, usecols=['description'])
+            for description in output['description']:
+                self._count(str(description).split(" "))
+
+        done_ids = set(pd.read_csv(output_csv, usecols=['id'])['id'])
+        return done_ids.union(self.dropped_ids)
+
+    def _save_checkpoint(self, output_csv, checkpoint_file):
+        checkpoint = {'output_bytes': os.path.getsize(output_csv),
+                      'unique_tokens': self.unique_tokens,
+                      'dropped_ids': self.dropped_ids}
+        tmp_file = checkpoint_file + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_file, checkpoint_file)
 
     def _count(self, description):
-        # check it token is in dictionary, either increment or add to dict
-        for token in description:
-            if token in self.unique_tokens:
-                self.unique_tokens.update({token: self.unique_tokens[token]+1})
-            else:
-                self.unique_tokens.update({token: 1})
-
-    def save_vocabulary(self, dir_name):
+        # counter keeps order of first occurrence --> same vocabulary order
+        self.unique_tokens.update(description)
+
+    def save_vocabulary(self, dir_name, threshold=2):
         '''
         voc[0] = END
         ...
         voc[N] = UNK
         '''
-        vocabulary = []
-        vocabulary.append("END")
-        for key in self.unique_tokens.keys():
-            if self.unique_tokens[key] > 2:
-                vocabulary.append(key)
-        vocabulary.append("UNK")
-        print("Saved vocabulary: " + dir_name)
-
-        # Calling DataFrame constructor on list
-        df = pd.DataFrame(vocabulary, columns=['vocabulary'])
-        df.to_csv(dir_name, index=False)
+        save_vocabulary(build_vocabulary(self.unique_tokens, threshold),
+                        dir_name)
 
     def save_data(self, dir_name):
         # Calling DataFrame constructor on dict
@@ -0,0 +1,66 @@
+import collections
+import multiprocessing
+
+import pandas as pd
+
+
+def count_tokens(descriptions):
+    '''
+    Counter of all space separated tokens of preprocessed descriptions
+    counter keeps order of first occurrence
+    '''
+
+    counts = collections.Counter()
+    for description in descriptions:
+        if type(description) == str:
+            counts.update(description.split(" "))
+    return counts
+
+
+def _iter_description_chunks(csv_files, chunk_size):
+    for csv_file in csv_files:
+        for chunk in pd.read_csv(csv_file, usecols=['description'],
+                                 chunksize=chunk_size):
+            yield chunk['description'].tolist()
+
+
+def count_csv_tokens(csv_files, n_workers=1, chunk_size=10000):
+    '''
+    map:    each worker counts tokens of one chunk of descriptions
+    reduce: counters are merged in order of chunks
+            --> same order of first occurrence as a single process count
+    '''
+
+    chunks = _iter_description_chunks(csv_files, chunk_size)
+    counts = collections.Counter()
+
+    if n_workers <= 1:
+        for chunk in chunks:
+            counts.update(count_tokens(chunk))
+        return counts
+
+    with multiprocessing.Pool(n_workers) as pool:
+        for chunk_counts in pool.imap(count_tokens, chunks):
+            counts.update(chunk_counts)
+    return counts
+
+
+def build_vocabulary(counts, threshold=2):
+    '''
+    voc[0] = END
+    ...     all tokens appearing more than threshold times
+    voc[N] = UNK
+    '''
+
+    vocabulary = ["END"]
+    vocabulary += [token for token, count in counts.items()
+                   if count > threshold]
+    vocabulary.append("UNK")
+    return vocabulary
+
+
+def save_vocabulary(vocabulary, dir_name):
+    # Calling DataFrame constructor on list
+    df = pd.DataFrame(vocabulary, columns=['vocabulary'])
+    df.to_csv(dir_name, index=False)
+    print("Saved vocabulary: " + dir_name)
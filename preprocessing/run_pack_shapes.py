@@ -0,0 +1,29 @@
+import argparse
+
+# needed for import from starting directory
+import sys
+import os
+sys.path.append(os.getcwd())
+
+from dataloader.ShapeStore import pack_nrrd_directory
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directory', type=str,
+                        help="directory of all nrrd files")
+    parser.add_argument('output_dir', type=str,
+                        help="directory where packed store is saved")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of processes reading nrrd files")
+    args = parser.parse_args()
+    return args
+
+def main(args):
+    pack_nrrd_directory(args.directory, args.output_dir, args.workers)
+    print("Saved packed shapes: " + args.output_dir)
+
+
+if __name__ == '__main__':
+    args =parse_arguments()
+    main(args)
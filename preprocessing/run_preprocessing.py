@@ -1,4 +1,5 @@
 import argparse
+import time
 
 from NatLangPreprocessor import NatLangPreprocessor
 
@@ -11,16 +12,39 @@ def parse_arguments():
                         help="preprocessed output file")
     parser.add_argument('output_voc_csv', type=str,
                         help="file where vocabular is saved")
+    parser.add_argument('--n_process', type=int, default=1,
+                        help="number of processes running spacy")
+    parser.add_argument('--batch_size', type=int, default=256,
+                        help="descriptions per spacy batch")
+    parser.add_argument('--correction_cache', type=str, default=None,
+                        help="sqlite file caching grammar corrections")
+    parser.add_argument('--stream', action='store_true',
+                        help="read input in chunks, append to output_csv and resume interrupted runs")
+    parser.add_argument('--chunk_size', type=int, default=10000,
+                        help="captions per chunk when streaming")
     args = parser.parse_args()
     return args
 
 def main(args):
     # run for preprocessor
-    prep = NatLangPreprocessor(args.input_csv)
-    prep.preprocess()
+    prep = NatLangPreprocessor(args.input_csv, args.correction_cache,
+                               args.stream)
+    start = time.time()
+    if args.stream:
+        n_descriptions = prep.preprocess_stream(
+            args.output_csv, args.chunk_size, n_process=args.n_process,
+            batch_size=args.batch_size)
+    else:
+        n_descriptions = prep.preprocess(n_process=args.n_process,
+                                         batch_size=args.batch_size)
+    duration = time.time() - start
+    print("Preprocessed {} descriptions in {:.1f} s ({:.1f} descriptions/s)".format(
+        n_descriptions, duration, n_descriptions / max(duration, 1e-9)))
 
     prep.save_vocabulary(args.output_voc_csv)
-    prep.save_data(args.output_csv)
+    # streaming already appended all chunks to output_csv
+    if not args.stream:
+        prep.save_data(args.output_csv)
 
 
 if __name__ == '__main__':
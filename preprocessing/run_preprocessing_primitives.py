@@ -1,4 +1,5 @@
 import argparse
+import time
 
 from NatLangPreprocessor import NatLangPreprocessor
 # needed for import from starting directory
@@ -7,7 +8,7 @@ import os
 sys.path.append(os.getcwd())
 print(sys.path)
 
-from dataloader.DataLoader import parse_primitives
+from dataloader.PrimitivesStore import load_primitives
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
@@ -19,14 +20,30 @@ def parse_arguments():
                         help="preprocessed output file")
     parser.add_argument('output_voc_csv', type=str,
                         help="file where vocabular is saved")
+    parser.add_argument('--packed', type=str, default=None,
+                        help="packed primitives directory, created if missing (same as packed_primitives in config)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of processes parsing folders")
+    parser.add_argument('--n_process', type=int, default=1,
+                        help="number of processes running spacy")
+    parser.add_argument('--batch_size', type=int, default=256,
+                        help="descriptions per spacy batch")
+    parser.add_argument('--correction_cache', type=str, default=None,
+                        help="sqlite file caching grammar corrections")
     args = parser.parse_args()
     return args
 
 def main(args):
     # run for preprocessor
-    _, descriptions = parse_primitives(args.directory, args.categorize)
-    prep = NatLangPreprocessor(descriptions)
-    prep.preprocess()
+    _, descriptions = load_primitives(args.directory, args.categorize,
+                                      args.packed, args.workers)
+    prep = NatLangPreprocessor(descriptions, args.correction_cache)
+    start = time.time()
+    n_descriptions = prep.preprocess(n_process=args.n_process,
+                                     batch_size=args.batch_size)
+    duration = time.time() - start
+    print("Preprocessed {} descriptions in {:.1f} s ({:.1f} descriptions/s)".format(
+        n_descriptions, duration, n_descriptions / max(duration, 1e-9)))
 
     prep.save_vocabulary(args.output_voc_csv)
     prep.save_data(args.output_csv)
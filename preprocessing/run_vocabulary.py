@@ -0,0 +1,35 @@
+import argparse
+import time
+
+from VocabularyBuilder import count_csv_tokens, build_vocabulary, \
+    save_vocabulary
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_csv', type=str, nargs='+',
+                        help="preprocessed caption file(s)")
+    parser.add_argument('output_voc_csv', type=str,
+                        help="file where vocabular is saved")
+    parser.add_argument('--threshold', type=int, default=2,
+                        help="tokens appearing more than threshold times are kept")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of processes counting tokens")
+    parser.add_argument('--chunk_size', type=int, default=10000,
+                        help="descriptions per counted chunk")
+    args = parser.parse_args()
+    return args
+
+def main(args):
+    start = time.time()
+    counts = count_csv_tokens(args.input_csv, args.workers, args.chunk_size)
+    vocabulary = build_vocabulary(counts, args.threshold)
+    print("Counted {} tokens, kept {} in {:.1f} s".format(
+        len(counts), len(vocabulary), time.time() - start))
+
+    save_vocabulary(vocabulary, args.output_voc_csv)
+
+
+if __name__ == '__main__':
+    args =parse_arguments()
+    main(args)
@@ -8,9 +8,8 @@ import numpy as np
 from utils.ConfigParser import retrieval_config_parser
 from models.Networks import TextEncoder, ShapeEncoder
 from dataloader.DataLoader import RetrievalLoader
-from utils.NearestNeighbor import find_nn_text_2_text, find_nn_text_2_shape, \
-    find_nn_shape_2_shape, find_nn_shape_2_text, \
-    calculate_ndcg
+from utils.NearestNeighbor import calculate_ndcg
+from utils.EmbeddingIndex import EmbeddingIndex
 
 #################################################################
 # TODO:
@@ -30,6 +29,54 @@ def parse_arguments():
     return args
 
 
+def prepare_approximate_search(index, config, query_modality, modality, k):
+    """
+    builds approximate index of modality if ann.n_lists > 0 in config
+    and checks its recall@k against exact search on random queries
+    returns recall and time per query or None for exact search
+    """
+
+    ann = config.get('ann', dict())
+    if ann.get('n_lists', 0) <= 0:
+        return None
+    if modality not in index.ann:
+        index.add_ann(modality, ann['n_lists'], ann.get('n_probe', 8))
+
+    n_queries = ann.get('recall_queries', 100)
+    rows = np.random.randint(
+        0, len(index.embeddings[query_modality]), n_queries)
+    recall = index.recall(query_modality, rows, modality, k)
+    print("...recall@{} {:.3f} - {:.2f} ms (approximate) vs {:.2f} ms (exact) per query".format(
+        k, recall["recall"], recall["ann_ms"], recall["exact_ms"]))
+    return recall
+
+
+def prepare_quantized_search(index, config, query_modality, modality, k,
+                             metric):
+    """
+    compresses embeddings of modality if quantization.method is set in config
+    and reports ndcg and recall@k deltas against float32 search
+    returns report or None without quantization
+    """
+
+    quantization = config.get('quantization', dict())
+    method = quantization.get('method', "none")
+    if method == "none":
+        return None
+    if modality not in index.quantized:
+        index.quantize(modality, method, quantization.get('n_subvectors', 16))
+
+    n_queries = quantization.get('report_queries', 100)
+    rows = np.random.randint(
+        0, len(index.embeddings[query_modality]), n_queries)
+    report = index.quantization_report(
+        query_modality, rows, modality, k, metric)
+    print("...{} - {:.1f}x smaller, ndcg {:.3f} --> {:.3f} ({:+.3f}), recall@{} {:.3f}".format(
+        method, report["compression"], report["ndcg"],
+        report["ndcg_quantized"], report["ndcg_delta"], k, report["recall"]))
+    return report
+
+
 def main(config):
     load_directory = []
     load_directory.append(config['directories']['shape_model_load'])
@@ -38,6 +85,8 @@ def main(config):
     # TODO: so far this is not necessary since loader base class
     #       functions are sufficent to load required data
     dataloader = RetrievalLoader(config)
+    index = EmbeddingIndex(
+        dataloader, config['directories'].get('embedding_index'))
 
     k = config["hyper_parameters"]["k"]
 
@@ -57,6 +106,18 @@ def main(config):
             text_encoder = text_encoder.to(device)
             text_encoder.load_state_dict(temp_net)
 
+            # corpus and queries are encoded once or reopened from embedding index
+            if "text" not in index.embeddings:
+                index.add("text", text_encoder, load_directory[1])
+            recall = prepare_approximate_search(
+                index, config, "text", "text", k)
+            if recall is not None:
+                ndcg_dict[version + "_recall"] = recall
+            report = prepare_quantized_search(
+                index, config, "text", "text", k, version)
+            if report is not None:
+                ndcg_dict[version + "_quantization"] = report
+
             ndcg_list = []
 
             for n in range(config["hyper_parameters"]["n"]):
@@ -65,10 +126,8 @@ def main(config):
                     0, dataloader.get_description_length())
                 rand_desc = dataloader.get_description(rand)
 
-                closest_idx, closest_dist = find_nn_text_2_text(text_encoder,
-                                                                rand_desc,
-                                                                dataloader,
-                                                                k)
+                closest_idx, closest_dist = index.search(
+                    "text", rand, "text", k)
 
                 ndcg = calculate_ndcg(closest_idx, rand, dataloader, k, "t2t")
                 ndcg_list.append(ndcg)
@@ -78,13 +137,10 @@ def main(config):
                 rand_desc = dataloader.txt_vectorization.vector2description(
                     rand_desc)
 
-                nearest_descriptions = []
-
-                for idx in closest_idx:
-                    d = dataloader.get_description(idx)
-                    d = d.reshape(96)
-                    nearest_descriptions.append(
-                        dataloader.txt_vectorization.vector2description(d))
+                # one gather from description matrix, decoded at once
+                nearest_descriptions = \
+                    dataloader.txt_vectorization.matrix2descriptions(
+                        dataloader.descriptions['description'][closest_idx])
 
                 dict_ = {rand_desc: nearest_descriptions}
 
@@ -117,6 +173,20 @@ def main(config):
             text_encoder = text_encoder.to(device)
             text_encoder.load_state_dict(temp_net)
 
+            # corpus and queries are encoded once or reopened from embedding index
+            if "shape" not in index.embeddings:
+                index.add("shape", shape_encoder, load_directory[0])
+            if "text" not in index.embeddings:
+                index.add("text", text_encoder, load_directory[1])
+            recall = prepare_approximate_search(
+                index, config, "text", "shape", k)
+            if recall is not None:
+                ndcg_dict[version + "_recall"] = recall
+            report = prepare_quantized_search(
+                index, config, "text", "shape", k, version)
+            if report is not None:
+                ndcg_dict[version + "_quantization"] = report
+
             ndcg_list = []
 
             for n in range(config["hyper_parameters"]["n"]):
@@ -124,11 +194,8 @@ def main(config):
                     0, dataloader.get_description_length())
                 rand_desc = dataloader.get_description(rand)
 
-                closest_idx, closest_dist = find_nn_text_2_shape(text_encoder,
-                                                                 shape_encoder,
-                                                                 rand_desc,
-                                                                 dataloader,
-                                                                 k)
+                closest_idx, closest_dist = index.search(
+                    "text", rand, "shape", k)
 
                 ndcg = calculate_ndcg(closest_idx, rand, dataloader, k, "t2s")
                 ndcg_list.append(ndcg)
@@ -175,6 +242,18 @@ def main(config):
             shape_encoder = shape_encoder.to(device)
             shape_encoder.load_state_dict(temp_net)
 
+            # corpus and queries are encoded once or reopened from embedding index
+            if "shape" not in index.embeddings:
+                index.add("shape", shape_encoder, load_directory[0])
+            recall = prepare_approximate_search(
+                index, config, "shape", "shape", k)
+            if recall is not None:
+                ndcg_dict[version + "_recall"] = recall
+            report = prepare_quantized_search(
+                index, config, "shape", "shape", k, version)
+            if report is not None:
+                ndcg_dict[version + "_quantization"] = report
+
             ndcg_list = []
 
             for n in range(config["hyper_parameters"]["n"]):
@@ -182,10 +261,8 @@ def main(config):
                 rand = np.random.randint(0, dataloader.get_shape_length())
                 rand_shape = dataloader.get_shape(rand)
 
-                closest_idx, closest_dist = find_nn_shape_2_shape(shape_encoder,
-                                                                  rand_shape, 
-                                                                  dataloader, 
-                                                                  k)
+                closest_idx, closest_dist = index.search(
+                    "shape", rand, "shape", k)
                 
                 ndcg = calculate_ndcg(closest_idx, rand, dataloader, k, "s2s")
                 ndcg_list.append(ndcg)
@@ -233,17 +310,28 @@ def main(config):
             text_encoder = text_encoder.to(device)
             text_encoder.load_state_dict(temp_net)
 
+            # corpus and queries are encoded once or reopened from embedding index
+            if "text" not in index.embeddings:
+                index.add("text", text_encoder, load_directory[1])
+            if "shape" not in index.embeddings:
+                index.add("shape", shape_encoder, load_directory[0])
+            recall = prepare_approximate_search(
+                index, config, "shape", "text", k)
+            if recall is not None:
+                ndcg_dict[version + "_recall"] = recall
+            report = prepare_quantized_search(
+                index, config, "shape", "text", k, version)
+            if report is not None:
+                ndcg_dict[version + "_quantization"] = report
+
             ndcg_list = []
 
             for n in range(config["hyper_parameters"]["n"]):
                 rand = np.random.randint(0, dataloader.get_shape_length())
                 rand_shape = dataloader.get_shape(rand)
 
-                closest_idx, closest_dist = find_nn_shape_2_text(shape_encoder,
-                                                                 text_encoder,
-                                                                 rand_shape,
-                                                                 dataloader,
-                                                                 k)
+                closest_idx, closest_dist = index.search(
+                    "shape", rand, "text", k)
 
                 ndcg = calculate_ndcg(closest_idx, rand, dataloader, k, "s2t")
                 ndcg_list.append(ndcg)
@@ -264,13 +352,10 @@ def main(config):
                 render.set_name("selected")
                 render.render_voxels(save_directory)
 
-                nearest_descriptions = []
-
-                for idx in closest_idx:
-                    d = dataloader.get_description(idx)
-                    d = d.reshape(96)
-                    nearest_descriptions.append(
-                        dataloader.txt_vectorization.vector2description(d))
+                # one gather from description matrix, decoded at once
+                nearest_descriptions = \
+                    dataloader.txt_vectorization.matrix2descriptions(
+                        dataloader.descriptions['description'][closest_idx])
 
                 dict_ = {"descriptions": nearest_descriptions}
 
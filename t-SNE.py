@@ -13,9 +13,8 @@ from utils.RenderShape import RenderImage
 from utils.ConfigParser import tsne_config_parser
 from models.Networks import TextEncoder, ShapeEncoder
 from dataloader.DataLoader import RetrievalLoader
-from utils.NearestNeighbor import find_nn_text_2_text, find_nn_text_2_shape, \
-    find_nn_shape_2_shape, find_nn_shape_2_text, \
-    calculate_ndcg
+from utils.EmbeddingIndex import EmbeddingIndex
+from utils.NearestNeighbor import encode_descriptions
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
@@ -23,9 +22,8 @@ def parse_arguments():
     args = parser.parse_args()
     return args
 
-def find_positive_shape_id(desc_id, dataloader):
-    matching_idx = [i for i, x in enumerate(
-        dataloader.shapes['modelId']) if x == desc_id]
+def find_positive_shape_id(model_code, dataloader):
+    matching_idx = dataloader.shape_index.get(model_code)
     if len(matching_idx) == 0:
         return None
     rand = np.random.randint(0, len(matching_idx))
@@ -46,15 +44,19 @@ def main(config):
     text_encoder.load_state_dict(temp_net)
 
     n = config["hyper_parameters"]["n"]
-    descriptions = []
     rand = np.random.randint(0, dataloader.get_description_length(), n)
-    for i in range(n):
-        descriptions.append(dataloader.get_description(rand[i]).tolist()[0])
-
-    X = torch.Tensor(descriptions).to(device=device).long()
-    X = text_encoder.forward(X)
 
-    X_encoded = X.cpu().detach().numpy()
+    # with embedding index all descriptions are encoded once and reopened
+    # otherwise only the n plotted descriptions are encoded
+    index_directory = config['directories'].get('embedding_index')
+    if index_directory is not None:
+        index = EmbeddingIndex(dataloader, index_directory)
+        index.add("text", text_encoder, load_directory)
+        X_encoded = np.asarray(index.embeddings["text"][rand])
+    else:
+        X_encoded = encode_descriptions(
+            text_encoder, dataloader.descriptions['description'][rand])
+        X_encoded = X_encoded.cpu().numpy()
     X_embedded = TSNE(n_components=2).fit_transform(X_encoded)
 
     x_min, x_max = np.min(X_embedded, 0), np.max(X_embedded, 0)
@@ -73,8 +75,8 @@ def main(config):
         os.makedirs(save_directory)
 
     for i in range(n):
-        desc_id = dataloader.descriptions['modelId'][rand[i]]
-        idx = find_positive_shape_id(desc_id, dataloader)
+        model_code = dataloader.descriptions['model_code'][rand[i]]
+        idx = find_positive_shape_id(model_code, dataloader)
         if idx != None:
             print('plot {} of {} '.format(
                 i, n), end='\r')
@@ -0,0 +1,36 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+spacy = pytest.importorskip("spacy")
+pytest.importorskip("language_tool_python")
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "preprocessing"))
+from NatLangPreprocessor import NatLangPreprocessor
+
+
+def run_stream(input_csv, output_csv):
+    prep = NatLangPreprocessor(input_csv, stream=True)
+    # no grammar correction (language tool) and no trained spacy model
+    prep.correction_cache.correct = lambda description: description
+    prep.nlp = spacy.blank("en")
+    prep.preprocess_stream(output_csv, chunk_size=2, max_length=96)
+    return prep
+
+
+def test_stream_resume_keeps_counts(tmp_path):
+    input_csv = str(tmp_path / "captions.csv")
+    output_csv = str(tmp_path / "prep.csv")
+    pd.DataFrame({"id": [0, 1, 2],
+                  "description": ["a red table", " ".join(100 * ["long"]),
+                                  "a round chair"]}).to_csv(input_csv,
+                                                            index=False)
+
+    first = run_stream(input_csv, output_csv)
+    second = run_stream(input_csv, output_csv)
+
+    assert first.unique_tokens["long"] == 100
+    assert second.unique_tokens == first.unique_tokens
+    assert list(pd.read_csv(output_csv)["id"]) == [0, 2]
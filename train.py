@@ -8,10 +8,11 @@ import numpy as np
 
 from utils.ConfigParser import config_parser
 from utils.TensorboardEvaluation import Evaluation
-from utils.NearestNeighbor import find_nn_shape_2_text, find_nn_shape_2_shape, \
-    find_nn_text_2_shape, find_nn_text_2_text, calculate_ndcg
+from utils.NearestNeighbor import calculate_ndcg
+from utils.EmbeddingIndex import EmbeddingIndex
 
 from dataloader.DataLoader import TripletLoader
+from dataloader.BatchPrefetcher import BatchPrefetcher
 
 from dataloader.TextDataVectorization import TxtVectorization
 
@@ -26,69 +27,70 @@ def parse_arguments():
 
 
 def run_metric(metric_list, n_neighbors, dataloader, encoder):
+    """
+    test data is encoded once into an in memory EmbeddingIndex
+    t2t and s2s queries are part of the embeddings --> removed from their
+    neighbors by the index
+    """
+
+    test_data = dataloader.test_data
+    index = EmbeddingIndex(test_data)
+    if any("t" in metric for metric in metric_list):
+        index.add("text", encoder.text_encoder)
+    if any("s" in metric for metric in metric_list):
+        index.add("shape", encoder.shape_encoder)
+
+    modality = {"t": "text", "s": "shape"}
     ndcg_scores = dict()
     for metric in metric_list:
-        if metric == "s2t":
-            ndcg = 0
-            for i in range(3):
-                rand = np.random.randint(
-                    0, dataloader.test_data.get_shape_length())
-                rand_shape = dataloader.test_data.get_shape(rand)
-                closest_idx, _ = find_nn_shape_2_text(encoder.shape_encoder,
-                                                    encoder.text_encoder,
-                                                    rand_shape,
-                                                    dataloader.test_data,
-                                                    n_neighbors)
-                ndcg += calculate_ndcg(
-                    closest_idx, rand, dataloader.test_data, n_neighbors, "s2t")
-            ndcg_scores["s2t_ndcg"] = ndcg/(i+1)
-
-        if metric == "s2s":
-            ndcg = 0
-            for i in range(3):
-                rand = np.random.randint(
-                    0, dataloader.test_data.get_shape_length())
-                rand_shape = dataloader.test_data.get_shape(rand)
-                closest_idx, _ = find_nn_shape_2_shape(encoder.shape_encoder,
-                                                    rand_shape,
-                                                    dataloader.test_data,
-                                                    n_neighbors)
-                ndcg += calculate_ndcg(
-                    closest_idx, rand, dataloader.test_data, n_neighbors, "s2s")
-            ndcg_scores["s2s_ndcg"] = ndcg/(i+1)
-
-        if metric == "t2t":
-            ndcg = 0
-            for i in range(3):
-                rand = np.random.randint(
-                    0, dataloader.test_data.get_description_length())
-                rand_desc = dataloader.test_data.get_description(rand)
-                closest_idx, _ = find_nn_text_2_text(encoder.text_encoder,
-                                                    rand_desc,
-                                                    dataloader.test_data,
-                                                    n_neighbors)
-                ndcg += calculate_ndcg(
-                    closest_idx, rand, dataloader.test_data, n_neighbors, "t2t")
-            ndcg_scores["t2t_ndcg"] = ndcg/(i+1)
-
-        if metric == "t2s":
-            ndcg = 0
-            for i in range(3):
-                rand = np.random.randint(
-                    0, dataloader.test_data.get_description_length())
-                rand_desc = dataloader.test_data.get_description(rand)
-                closest_idx, _ = find_nn_text_2_shape(encoder.text_encoder,
-                                                    encoder.shape_encoder,
-                                                    rand_desc,
-                                                    dataloader.test_data,
-                                                    n_neighbors)
-                ndcg += calculate_ndcg(
-                    closest_idx, rand, dataloader.test_data, n_neighbors, "t2s")
-            ndcg_scores["t2s_ndcg"] = ndcg/(i+1)
+        query_modality = modality[metric[0]]
+        length = len(index.embeddings[query_modality])
+
+        ndcg = 0
+        for i in range(3):
+            rand = np.random.randint(0, length)
+            closest_idx, _ = index.search(
+                query_modality, rand, modality[metric[-1]], n_neighbors)
+            ndcg += calculate_ndcg(
+                closest_idx, rand, test_data, n_neighbors, metric)
+        ndcg_scores[metric + "_ndcg"] = ndcg/(i+1)
 
     return ndcg_scores
 
 
+def generate_batch(dataloader, config, data):
+    """
+    returns batch and batch_2 (0 if not needed) as given in config
+    data:   train or test
+    """
+
+    triplet_versions = config['triplet']
+    if data == "train":
+        get_batch = dataloader.get_train_batch
+        get_smart_batch = dataloader.get_train_smart_batch
+    if data == "test":
+        get_batch = dataloader.get_test_batch
+        get_smart_batch = dataloader.get_test_smart_batch
+
+    generate_batch = config['generate_batch']
+    if generate_batch == "mixed":
+        generate_list = ["random", "smart"]
+        generate_batch = random.choice(generate_list)
+
+    if generate_batch == "smart":
+        get_batch = get_smart_batch
+
+    if config['generate_condition'] == "uni_modal":
+        version = random.choice(triplet_versions)
+        batch = get_batch(version)
+        batch_2 = 0
+    if config['generate_condition'] == "cross_modal":
+        batch = get_batch(triplet_versions[0])
+        batch_2 = get_batch(triplet_versions[1])
+
+    return batch, batch_2
+
+
 def better_ndcg_scores(ndcg_scores, best_ndcg_scores):
     larger_ndcg_scores = list()
     for key, _ in ndcg_scores.items():
@@ -130,7 +132,11 @@ def main(config):
     trip_enc = TripletEncoder(config, dataloader.length_voc)
 
     epochs = config['hyper_parameters']['ep']
-    triplet_versions = config['triplet']
+
+    # batches are generated by worker threads while training
+    prefetch = config.get('prefetch', dict())
+    prefetch_workers = prefetch.get('workers', 1)
+    prefetch_depth = prefetch.get('depth', 2)
 
     print("...starting training")
 
@@ -141,32 +147,13 @@ def main(config):
         number_of_batches = int(
             dataloader.train_data.get_shape_length()/dataloader.bs)
         epoch_train_dict = eval_dict = {"loss": 0.0, "accuracy": 0.0}
-        for i in range(number_of_batches):
+        train_batches = BatchPrefetcher(
+            lambda: generate_batch(dataloader, config, "train"),
+            number_of_batches, prefetch_workers, prefetch_depth)
+        for i, (batch, batch_2) in enumerate(train_batches):
             print('TRAIN: input {} of {} '.format(
                 i, number_of_batches), end='\r')
 
-            generate_batch = config['generate_batch']
-            if generate_batch == "mixed":
-                generate_list = ["random", "smart"]
-                generate_batch = random.choice(generate_list)
-
-            if generate_batch == "random":
-                if config['generate_condition'] == "uni_modal":
-                    version = random.choice(triplet_versions)
-                    batch = dataloader.get_train_batch(version)
-                    batch_2 = 0
-                if config['generate_condition'] == "cross_modal":
-                    batch = dataloader.get_train_batch(triplet_versions[0])
-                    batch_2 = dataloader.get_train_batch(triplet_versions[1])
-            if generate_batch == "smart":
-                if config['generate_condition'] == "uni_modal":
-                    version = random.choice(triplet_versions)
-                    batch = dataloader.get_train_smart_batch(version)
-                    batch_2 = 0
-                if config['generate_condition'] == "cross_modal":
-                    batch = dataloader.get_train_smart_batch(triplet_versions[0])
-                    batch_2 = dataloader.get_train_smart_batch(triplet_versions[1])
-    
             train_dict = trip_enc.update(batch, batch_2)
             epoch_train_dict["loss"] += train_dict["loss"]
             epoch_train_dict["accuracy"] += train_dict["accuracy"]
@@ -179,31 +166,12 @@ def main(config):
         number_of_batches = int(
             dataloader.test_data.get_shape_length()/dataloader.bs)
         epoch_eval_dict = {"loss": 0.0, "accuracy": 0.0, "ndcg": 0.0}
-        for i in range(number_of_batches):
+        test_batches = BatchPrefetcher(
+            lambda: generate_batch(dataloader, config, "test"),
+            number_of_batches, prefetch_workers, prefetch_depth)
+        for i, (batch, batch_2) in enumerate(test_batches):
             print('EVAL: input {} of {} '.format(
                 i, number_of_batches), end='\r')
-            
-            generate_batch = config['generate_batch']
-            if generate_batch == "mixed":
-                generate_list = ["random", "smart"]
-                generate_batch = random.choice(generate_list)
-
-            if generate_batch == "random":
-                if config['generate_condition'] == "uni_modal":
-                    version = random.choice(triplet_versions)
-                    batch = dataloader.get_test_batch(version)
-                    batch_2 = 0
-                if config['generate_condition'] == "cross_modal":
-                    batch = dataloader.get_test_batch(triplet_versions[0])
-                    batch_2 = dataloader.get_test_batch(triplet_versions[1])
-            if generate_batch == "smart":
-                if config['generate_condition'] == "uni_modal":
-                    version = random.choice(triplet_versions)
-                    batch = dataloader.get_test_smart_batch(version)
-                    batch_2 = 0
-                if config['generate_condition'] == "cross_modal":
-                    batch = dataloader.get_test_smart_batch(triplet_versions[0])
-                    batch_2 = dataloader.get_test_smart_batch(triplet_versions[1])
 
             eval_dict = trip_enc.predict(batch, batch_2)
             epoch_eval_dict["loss"] += eval_dict["loss"]
@@ -221,6 +189,11 @@ def main(config):
 
         tensorboard_eval.write_episode_data(ep, eval_dict)
 
+        # lazy shape storage shares one cache between train and test
+        shape_data = dataloader.train_data.shapes['data']
+        if hasattr(shape_data, "cache_info"):
+            print("...shape cache: {}".format(shape_data.cache_info()))
+
         # check if ndcg scores are better than before
         # all metrices musst be better than best one before
 
@@ -74,6 +74,10 @@ def config_parser(config_file, print_config=True):
         raise Exception(
             "Check config file - dataset must be either <primitives> or <shapenet>")
 
+    if cfg.get('shape_storage', "dense") not in ["dense", "sparse", "lazy"]:
+        raise Exception(
+            "Check config file - shape_storage must be either <dense>, <sparse> or <lazy>")
+
     hp_ = cfg.get('hyper_parameters')
     dir_ = cfg.get('directories')
 
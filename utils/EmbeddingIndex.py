@@ -0,0 +1,310 @@
+import torch
+import numpy as np
+
+import hashlib
+import os
+
+from dataloader.DataCache import fingerprint
+from utils.NearestNeighbor import encode_descriptions, encode_shapes, \
+    knn_search, knn_search_chunked, calculate_ndcg
+from utils.IVFIndex import IVFIndex
+from utils.QuantizedEmbeddings import QuantizedEmbeddings
+
+
+def checkpoint_hash(file_name):
+    """
+    hash over content of saved encoder
+    """
+
+    sha = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            sha.update(block)
+    return sha.hexdigest()[:16]
+
+
+def array_hash(array, chunk_rows=4096):
+    """
+    hash over content of array, gathered in chunks of rows
+    (memory maps and sparse or lazy shapes)
+    """
+
+    sha = hashlib.sha1()
+    for start in range(0, len(array), chunk_rows):
+        rows = np.arange(start, min(start + chunk_rows, len(array)))
+        sha.update(np.ascontiguousarray(array[rows]))
+    return sha.hexdigest()[:16]
+
+
+class EmbeddingIndex(object):
+    """
+    embeddings of all descriptions (text) and shapes (shape) of a loader
+        embeddings[modality]    [N, emb] float32
+        model_ids[modality]     modelId of each row
+        categories[modality]    category of each row
+    with directory each modality is saved as
+        <modality>.npy          embeddings, memory mapped when reopened
+        <modality>.npz          modelId, category and tag
+        saved embeddings are only memory mapped, not held in memory
+    tag = hash of encoder checkpoint + hash of loader rows + data hash
+        text    hash of description token matrix
+        shape   data_key of loader (input files), else hash of shape data
+        --> index of another checkpoint or other data is stale and rebuild
+    without directory (or checkpoint) everything is kept in memory only
+    add_ann builds an approximate IVFIndex of a modality, used by search
+    quantize compresses a modality (QuantizedEmbeddings), used by search
+        with directory codes are saved next to the embeddings
+        <modality>.<method>.npy codes, memory mapped when reopened
+        <modality>.<method>.npz parameters and tag (+ method, n_subvectors)
+        float32 embeddings of a quantized modality are only read in chunks
+    """
+
+    def __init__(self, loader, directory=None):
+        self.loader = loader
+        self.directory = directory
+        self.embeddings = dict()
+        self.model_ids = dict()
+        self.categories = dict()
+        self.tensors = dict()
+        self.ann = dict()
+        self.quantized = dict()
+        self.tags = dict()
+
+    def __columns(self, modality):
+        if modality == "text":
+            return self.loader.descriptions
+        if modality == "shape":
+            return self.loader.shapes
+        raise Exception("Unknown modality {} - use text or shape".format(
+            modality))
+
+    def add(self, modality, encoder, checkpoint=None):
+        """
+        embeddings of modality, either reopened or encoded with encoder
+        checkpoint: file of encoder, needed to save and reopen index
+        """
+
+        columns = self.__columns(modality)
+        self.model_ids[modality] = columns['modelId']
+        self.categories[modality] = columns['category']
+        self.tensors.pop(modality, None)
+        self.ann.pop(modality, None)
+        self.quantized.pop(modality, None)
+        self.tags.pop(modality, None)
+
+        persistent = self.directory is not None and checkpoint is not None
+        if persistent:
+            tag = "{}-{}-{}".format(
+                checkpoint_hash(checkpoint),
+                fingerprint(columns['modelId'], columns['category']),
+                self.__data_hash(modality, columns))
+            self.tags[modality] = tag
+            embeddings = self.__load(modality, tag)
+            if embeddings is not None:
+                print("...loaded {} embeddings".format(modality))
+                self.embeddings[modality] = embeddings
+                return self.embeddings[modality]
+
+        print("...encoding {} embeddings".format(modality))
+        if modality == "text":
+            embeddings = encode_descriptions(encoder, columns['description'])
+        if modality == "shape":
+            embeddings = encode_shapes(encoder, columns['data'])
+        self.embeddings[modality] = embeddings.cpu().numpy()
+
+        if persistent:
+            self.__save(modality, tag)
+            # encoded copy is dropped, saved file is memory mapped
+            self.embeddings[modality] = np.load(
+                self.__files(modality)[0], mmap_mode='r')
+        return self.embeddings[modality]
+
+    def __data_hash(self, modality, columns):
+        if modality == "text":
+            return array_hash(np.asarray(columns['description']))
+        data_key = getattr(self.loader, 'data_key', None)
+        if data_key is not None:
+            return data_key
+        return array_hash(columns['data'])
+
+    def __files(self, modality):
+        return os.path.join(self.directory, modality + ".npy"), \
+            os.path.join(self.directory, modality + ".npz")
+
+    def __code_files(self, modality, method):
+        name = "{}.{}".format(modality, method)
+        return os.path.join(self.directory, name + ".npy"), \
+            os.path.join(self.directory, name + ".npz")
+
+    def __load(self, modality, tag):
+        data_file, meta_file = self.__files(modality)
+        if not os.path.isfile(data_file) or not os.path.isfile(meta_file):
+            return None
+        with np.load(meta_file) as meta:
+            if str(meta['tag']) != tag:
+                print("...{} embeddings are stale".format(modality))
+                return None
+        embeddings = np.load(data_file, mmap_mode='r')
+        if len(embeddings) != len(self.model_ids[modality]):
+            return None
+        return embeddings
+
+    def __save(self, modality, tag):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        data_file, meta_file = self.__files(modality)
+        # meta is written last --> tag only matches complete embeddings
+        tmp_file = data_file[:-len(".npy")] + ".tmp.npy"
+        np.save(tmp_file, self.embeddings[modality])
+        os.replace(tmp_file, data_file)
+        tmp_file = meta_file[:-len(".npz")] + ".tmp.npz"
+        np.savez(tmp_file, tag=np.array(tag),
+                 modelId=np.asarray(self.model_ids[modality], dtype=str),
+                 category=np.asarray(self.categories[modality], dtype=str))
+        os.replace(tmp_file, meta_file)
+
+    def tensor(self, modality):
+        """
+        embeddings as torch tensor, read once from memory map
+        """
+
+        if modality not in self.tensors:
+            self.tensors[modality] = torch.from_numpy(
+                np.array(self.embeddings[modality], dtype=np.float32))
+        return self.tensors[modality]
+
+    def add_ann(self, modality, n_lists=None, n_probe=8, n_iter=20,
+                train_size=None):
+        """
+        approximate index over embeddings of modality (see IVFIndex)
+        """
+
+        print("...building approximate {} index".format(modality))
+        self.ann[modality] = IVFIndex(
+            self.embeddings[modality], n_lists, n_probe, n_iter, train_size)
+        return self.ann[modality]
+
+    def quantize(self, modality, method="pq", n_subvectors=16):
+        """
+        compressed embeddings of modality (see QuantizedEmbeddings)
+        reopened if codes of same embeddings and settings are saved
+        """
+
+        # exact search on a quantized modality reads float32 in chunks
+        self.tensors.pop(modality, None)
+
+        tag = self.tags.get(modality)
+        if tag is not None:
+            tag = "{}-{}-{}".format(tag, method, n_subvectors)
+            quantized = self.__load_codes(modality, method, tag)
+            if quantized is not None:
+                print("...loaded {} codes ({})".format(modality, method))
+                self.quantized[modality] = quantized
+                return quantized
+
+        print("...quantizing {} embeddings ({})".format(modality, method))
+        quantized = QuantizedEmbeddings(
+            self.embeddings[modality], method, n_subvectors)
+        if tag is not None:
+            self.__save_codes(modality, quantized, tag)
+            quantized.codes = np.load(
+                self.__code_files(modality, method)[0], mmap_mode='r')
+        self.quantized[modality] = quantized
+        return quantized
+
+    def __load_codes(self, modality, method, tag):
+        code_file, meta_file = self.__code_files(modality, method)
+        if not os.path.isfile(code_file) or not os.path.isfile(meta_file):
+            return None
+        with np.load(meta_file) as meta:
+            if str(meta['tag']) != tag:
+                return None
+            state = {key: meta[key] for key in meta.files if key != 'tag'}
+        codes = np.load(code_file, mmap_mode='r')
+        if len(codes) != len(self.model_ids[modality]):
+            return None
+        return QuantizedEmbeddings.from_state(codes, state)
+
+    def __save_codes(self, modality, quantized, tag):
+        code_file, meta_file = self.__code_files(modality, quantized.method)
+        # meta is written last --> tag only matches complete codes
+        tmp_file = code_file[:-len(".npy")] + ".tmp.npy"
+        np.save(tmp_file, quantized.codes)
+        os.replace(tmp_file, code_file)
+        tmp_file = meta_file[:-len(".npz")] + ".tmp.npz"
+        np.savez(tmp_file, tag=np.array(tag), **quantized.state())
+        os.replace(tmp_file, meta_file)
+
+    def search(self, query_modality, rows, modality, k, exact=False):
+        """
+        k nearest rows of modality for rows of query_modality
+            approximate if add_ann was called for modality (and not exact)
+            else on compressed codes if modality was quantized (and not exact)
+        same modality --> query row itself is removed from its neighbors
+        """
+
+        queries = np.asarray(self.embeddings[query_modality][rows],
+                             dtype=np.float32)
+        exclude = None
+        if query_modality == modality:
+            exclude = np.atleast_1d(rows)
+        if modality in self.ann and not exact:
+            return self.ann[modality].search(queries, k, exclude)
+        if modality in self.quantized:
+            if not exact:
+                return self.quantized[modality].search(queries, k, exclude)
+            return knn_search_chunked(queries, self.embeddings[modality], k,
+                                      exclude)
+        return knn_search(torch.from_numpy(queries), self.tensor(modality),
+                          k, exclude=exclude)
+
+    def recall(self, query_modality, rows, modality, k):
+        """
+        recall@k and time per query of approximate against exact search
+        """
+
+        queries = np.asarray(self.embeddings[query_modality][rows])
+        exclude = None
+        if query_modality == modality:
+            exclude = np.atleast_1d(rows)
+        return self.ann[modality].recall(queries, k, exclude)
+
+    def quantization_report(self, query_modality, rows, modality, k,
+                            metric):
+        """
+        accuracy lost by quantization of modality for rows of query_modality
+            ndcg            mean calculate_ndcg on exact float32 search
+            ndcg_quantized  mean calculate_ndcg on compressed codes
+            ndcg_delta      ndcg_quantized - ndcg
+            recall          share of exact k neighbors found on codes
+            compression     float32 bytes / compressed bytes
+        """
+
+        exact_idx, _ = self.search(query_modality, rows, modality, k,
+                                   exact=True)
+        queries = np.asarray(self.embeddings[query_modality][rows],
+                             dtype=np.float32)
+        exclude = None
+        if query_modality == modality:
+            exclude = np.atleast_1d(rows)
+        quantized = self.quantized[modality]
+        quantized_idx, _ = quantized.search(queries, k, exclude)
+
+        ndcg = []
+        ndcg_quantized = []
+        recall = []
+        for row, exact, approx in zip(rows, exact_idx, quantized_idx):
+            ndcg.append(calculate_ndcg(exact, row, self.loader, k, metric))
+            ndcg_quantized.append(
+                calculate_ndcg(approx, row, self.loader, k, metric))
+            recall.append(len(np.intersect1d(exact, approx)) /
+                          max(len(exact), 1))
+
+        report = {"method": quantized.method,
+                  "ndcg": float(np.mean(ndcg)),
+                  "ndcg_quantized": float(np.mean(ndcg_quantized)),
+                  "recall": float(np.mean(recall)),
+                  "compression": float(
+                      self.embeddings[modality].nbytes / quantized.nbytes)}
+        report["ndcg_delta"] = report["ndcg_quantized"] - report["ndcg"]
+        return report
@@ -0,0 +1,185 @@
+import numpy as np
+
+import time
+
+
+def squared_distances(a, b):
+    """
+    squared euclidean distance of each row of a [Q, emb] to each row of
+    b [N, emb] as one matrix product
+    """
+
+    dist = (a**2).sum(axis=1)[:, None] - 2 * a @ b.T + (b**2).sum(axis=1)
+    return np.maximum(dist, 0)
+
+
+def exclude_rows(closest_idx, closest_dist, exclude):
+    """
+    removes row exclude[q] from the sorted neighbors [Q, n] of query q
+    (query is part of the embeddings but not always ranked first,
+    e.g. on duplicates or approximate distances)
+    queries whose row is not among the neighbors lose their last one
+    returns closest_idx, closest_dist [Q, n - 1]
+    """
+
+    if closest_idx.shape[1] == 0:
+        return closest_idx, closest_dist
+    drop = closest_idx == np.asarray(exclude).reshape(-1, 1)
+    drop[~drop.any(axis=1), -1] = True
+    shape = (len(closest_idx), closest_idx.shape[1] - 1)
+    return closest_idx[~drop].reshape(shape), \
+        closest_dist[~drop].reshape(shape)
+
+
+def kmeans(data, n_clusters, n_iter=20, seed=0, chunk_size=65536):
+    """
+    lloyd k-means, centroids start at random rows of data
+    empty clusters restart at a random row
+    returns centroids [n_clusters, emb]
+    """
+
+    random = np.random.RandomState(seed)
+    centroids = data[random.choice(len(data), n_clusters, replace=False)]
+    for _ in range(n_iter):
+        assignment = assign(data, centroids, chunk_size)
+        counts = np.bincount(assignment, minlength=n_clusters)
+        # rows sorted by cluster --> sum of each cluster is one reduceat
+        order = np.argsort(assignment, kind='stable')
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        empty = counts == 0
+        sums = np.zeros_like(centroids)
+        sums[~empty] = np.add.reduceat(data[order], starts[~empty], axis=0)
+
+        centroids = (sums / np.maximum(counts, 1)[:, None]).astype(data.dtype)
+        centroids[empty] = data[random.randint(0, len(data), empty.sum())]
+    return centroids
+
+
+def assign(data, centroids, chunk_size=65536):
+    """
+    nearest centroid of each row, computed in chunks of rows
+    """
+
+    assignment = np.empty(len(data), dtype=np.int64)
+    centroid_norms = (centroids**2).sum(axis=1)
+    for start in range(0, len(data), chunk_size):
+        # |row|^2 is same for all centroids --> not needed for argmin
+        chunk = data[start:start + chunk_size]
+        assignment[start:start + chunk_size] = (
+            centroid_norms - 2 * chunk @ centroids.T).argmin(axis=1)
+    return assignment
+
+
+class IVFIndex(object):
+    """
+    approximate nearest neighbors on embeddings [N, emb] (inverted file)
+        k-means splits embeddings into n_lists lists (coarse quantizer)
+        rows of one list are stored next to each other (like RowIndex)
+        query visits its n_probe nearest lists, exact distance within them
+        further lists are visited until k neighbors are found
+        (lists may be empty since k-means only sees train_size rows)
+    knobs
+        n_lists     more lists --> less rows per probe, faster, lower recall
+        n_probe     more probes --> more rows visited, slower, higher recall
+                    n_probe == n_lists is exact search
+        train_size  k-means runs on at most train_size random rows
+    distances are mean squared errors as in knn_search
+    """
+
+    def __init__(self, embeddings, n_lists=None, n_probe=8, n_iter=20,
+                 train_size=None, seed=0):
+        self.embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        n_rows = len(self.embeddings)
+        if n_lists is None:
+            n_lists = int(np.sqrt(n_rows))
+        self.n_lists = max(1, min(n_lists, n_rows))
+        self.n_probe = n_probe
+        if train_size is None:
+            train_size = 256 * self.n_lists
+
+        random = np.random.RandomState(seed)
+        train = self.embeddings
+        if n_rows > train_size:
+            train = train[random.choice(n_rows, train_size, replace=False)]
+        self.centroids = kmeans(train, self.n_lists, n_iter, seed)
+
+        assignment = assign(self.embeddings, self.centroids)
+        self.counts = np.bincount(assignment, minlength=self.n_lists)
+        self.rows = np.argsort(assignment, kind='stable')
+        self.offsets = np.concatenate(([0], np.cumsum(self.counts)))
+
+    def search(self, queries, k, exclude=None, n_probe=None):
+        """
+        k approximate nearest rows for each query [Q, emb]
+        exclude: row of each query [Q] if queries are part of embeddings
+                 --> removed from its neighbors (see exclude_rows)
+        returns closest_idx, closest_dist as numpy [Q, k] or [k] for one
+        query [emb], same shapes as knn_search
+        """
+
+        if n_probe is None:
+            n_probe = self.n_probe
+        n_probe = max(1, min(n_probe, self.n_lists))
+
+        queries = np.asarray(queries, dtype=np.float32)
+        single = queries.ndim == 1
+        queries = queries.reshape(-1, self.embeddings.shape[1])
+
+        n = min(k + int(exclude is not None), len(self.embeddings))
+        closest_idx = np.zeros((len(queries), n), dtype=np.int64)
+        closest_dist = np.zeros((len(queries), n), dtype=np.float32)
+
+        order = np.argsort(squared_distances(queries, self.centroids),
+                           axis=1, kind='stable')
+        for q, (query, probe) in enumerate(zip(queries, order)):
+            if n == 0:
+                break
+            # at least n_probe lists and enough rows for n neighbors
+            found = np.cumsum(self.counts[probe])
+            n_visit = max(n_probe, np.searchsorted(found, n) + 1)
+            candidates = np.concatenate(
+                [self.rows[self.offsets[p]:self.offsets[p + 1]]
+                 for p in probe[:n_visit]])
+            dist = ((self.embeddings[candidates] - query)**2).mean(axis=1)
+
+            nearest = np.argpartition(dist, n - 1)[:n]
+            nearest = nearest[np.argsort(dist[nearest], kind='stable')]
+            closest_idx[q] = candidates[nearest]
+            closest_dist[q] = dist[nearest]
+
+        if exclude is not None:
+            closest_idx, closest_dist = exclude_rows(
+                closest_idx, closest_dist, exclude)
+        if single:
+            return closest_idx[0], closest_dist[0]
+        return closest_idx, closest_dist
+
+    def recall(self, queries, k, exclude=None, n_probe=None):
+        """
+        recall@k of search against exact search for queries [Q, emb]
+            recall      share of exact k neighbors found by search
+            ann_ms      ms per query of search
+            exact_ms    ms per query of exact search over all embeddings
+        """
+
+        queries = np.asarray(queries, dtype=np.float32).reshape(
+            -1, self.embeddings.shape[1])
+
+        start = time.time()
+        closest_idx, _ = self.search(queries, k, exclude, n_probe)
+        ann_ms = (time.time() - start) * 1000 / len(queries)
+
+        start = time.time()
+        n = k + int(exclude is not None)
+        dist = squared_distances(queries, self.embeddings)
+        exact_idx = np.argsort(dist, axis=1, kind='stable')[:, :n]
+        if exclude is not None:
+            exact_idx, _ = exclude_rows(
+                exact_idx, np.take_along_axis(dist, exact_idx, axis=1),
+                exclude)
+        exact_ms = (time.time() - start) * 1000 / len(queries)
+
+        found = [len(np.intersect1d(approx, exact)) / max(len(exact), 1)
+                 for approx, exact in zip(closest_idx, exact_idx)]
+        return {"recall": float(np.mean(found)), "ann_ms": ann_ms,
+                "exact_ms": exact_ms}
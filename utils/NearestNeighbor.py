@@ -1,122 +1,161 @@
 import torch
 import numpy as np
 
+from utils.IVFIndex import exclude_rows, squared_distances
 
-def find_nn_text_2_text(model, input_, loader, k):
-    model.eval()
-    input_ = torch.from_numpy(input_).long()
-    if torch.cuda.is_available():
-        input_ = input_.to('cuda')
-
-    criterion = torch.nn.MSELoss()
-
-    output_q = model(input_)
-    loss_L2 = np.array([])
-    for i in range(loader.get_description_length()):
-        print("Calculate L2 loss for {} of {}".format(
-            i, loader.get_description_length()), end='\r')
-        data = loader.get_description(i)
-        data = torch.from_numpy(data).long()
-        if torch.cuda.is_available():
-            data = data.to('cuda')
-        output = model(data)
-        loss_L2 = np.append(loss_L2, criterion(output_q, output).item())
-    print()
-
-    idx = np.argsort(loss_L2)
-    # start with 1 to remove comparison with its own
-    closest_idx = idx[1:k+1]
-    closest_dist = loss_L2[idx[1:k+1]]
-    return closest_idx, closest_dist
+
+def _model_device(model):
+    return next(model.parameters()).device
 
 
-def find_nn_shape_2_shape(model, input_, loader, k):
+def encode_descriptions(model, descriptions, bs=256):
+    """
+    embeddings [N, emb] of all rows of a description matrix [N, max_length]
+    encoded in batches of bs without gradients
+    """
+
     model.eval()
+    device = _model_device(model)
+    outputs = []
+    with torch.no_grad():
+        for start in range(0, len(descriptions), bs):
+            batch = np.asarray(descriptions[start:start + bs])
+            batch = torch.from_numpy(batch).long().to(device)
+            outputs.append(model(batch))
+    if len(outputs) == 0:
+        return torch.zeros((0, 128), device=device)
+    return torch.cat(outputs)
+
+
+def encode_shapes(model, shapes, bs=32):
+    """
+    embeddings [N, emb] of all shapes
+    shapes are gathered by index array --> dense batch for every storage
+    """
 
-    input_ = torch.from_numpy(input_).float()
-    if torch.cuda.is_available():
-        input_ = input_.to('cuda')
-
-    criterion = torch.nn.MSELoss()
-
-    output_q = model(input_)
-    loss_L2 = np.array([])
-    for i in range(loader.get_shape_length()):
-        print("Calculate L2 loss for {} of {}".format(
-            i, loader.get_shape_length()), end='\r')
-        data = loader.get_shape(i)
-        data = torch.from_numpy(data).float()
-        if torch.cuda.is_available():
-            data = data.to('cuda')
-        output = model(data)
-        loss_L2 = np.append(loss_L2, criterion(output_q, output).item())
-    print()
-
-    idx = np.argsort(loss_L2)
-    # start with 1 to remove comparison with its own
-    closest_idx = idx[1:k+1]
-    closest_dist = loss_L2[idx[1:k+1]]
-    return closest_idx, closest_dist
+    model.eval()
+    device = _model_device(model)
+    outputs = []
+    with torch.no_grad():
+        for start in range(0, len(shapes), bs):
+            batch = shapes[np.arange(start, min(start + bs, len(shapes)))]
+            batch = torch.from_numpy(batch).to(device)
+            outputs.append(model(batch))
+    if len(outputs) == 0:
+        return torch.zeros((0, 128), device=device)
+    return torch.cat(outputs)
+
+
+def knn_search(queries, embeddings, k, skip=0, exclude=None):
+    """
+    k nearest rows of embeddings [N, emb] for each query [Q, emb]
+        distance is the mean squared error (same as MSELoss)
+        one cdist for all queries, neighbors selected with topk
+        skip first neighbors (e.g. 1 if query is part of embeddings)
+        exclude: row of each query [Q] within embeddings, removed from
+                 its neighbors wherever it is ranked (see exclude_rows)
+    returns closest_idx, closest_dist as numpy [Q, k] or [k] for one
+    query [emb]
+    """
 
+    single = queries.dim() == 1
+    queries = queries.reshape(-1, embeddings.shape[1]).to(embeddings.device)
 
-def find_nn_shape_2_text(shape_model, text_model, input_, loader, k):
-    shape_model.eval()
-    text_model.eval()
+    dist = torch.cdist(queries, embeddings).pow(2) / embeddings.shape[1]
+    n = min(k + skip + int(exclude is not None), embeddings.shape[0])
+    closest_dist, closest_idx = torch.topk(dist, n, dim=1, largest=False)
 
-    input_ = torch.from_numpy(input_).float()
-    if torch.cuda.is_available():
-        input_ = input_.to('cuda')
+    closest_idx = closest_idx[:, skip:].cpu().numpy()
+    closest_dist = closest_dist[:, skip:].cpu().numpy()
+    if exclude is not None:
+        closest_idx, closest_dist = exclude_rows(
+            closest_idx, closest_dist, exclude)
+    if single:
+        return closest_idx[0], closest_dist[0]
+    return closest_idx, closest_dist
 
-    criterion = torch.nn.MSELoss()
 
-    output_q = shape_model(input_)
-    loss_L2 = np.array([])
-    for i in range(loader.get_description_length()):
-        print("Calculate L2 loss for {} of {}".format(
-            i, loader.get_description_length()), end='\r')
-        data = loader.get_description(i)
-        data = torch.from_numpy(data).long()
-        if torch.cuda.is_available():
-            data = data.to('cuda')
-        output = text_model(data)
-        loss_L2 = np.append(loss_L2, criterion(output_q, output).item())
-    print()
+def knn_search_chunked(queries, embeddings, k, exclude=None,
+                       chunk_size=65536):
+    """
+    same as knn_search for numpy queries [Q, emb] and embeddings [N, emb]
+    embeddings (e.g. memory map) are read in chunks of rows, only the best
+    k of all chunks so far are kept --> embeddings are never fully in memory
+    """
 
-    idx = np.argsort(loss_L2)
-    # start with 1 to remove comparison with its own
-    closest_idx = idx[1:k+1]
-    closest_dist = loss_L2[idx[1:k+1]]
+    queries = np.asarray(queries, dtype=np.float32)
+    single = queries.ndim == 1
+    queries = queries.reshape(-1, embeddings.shape[1])
+    n = min(k + int(exclude is not None), len(embeddings))
+
+    closest_idx = np.zeros((len(queries), 0), dtype=np.int64)
+    closest_dist = np.zeros((len(queries), 0), dtype=np.float32)
+    for start in range(0, len(embeddings), chunk_size):
+        chunk = np.asarray(embeddings[start:start + chunk_size],
+                           dtype=np.float32)
+        dist = squared_distances(queries, chunk) / embeddings.shape[1]
+        idx = np.broadcast_to(np.arange(start, start + len(chunk)),
+                              dist.shape)
+        dist = np.concatenate((closest_dist, dist), axis=1)
+        idx = np.concatenate((closest_idx, idx), axis=1)
+        # rows of earlier chunks come first --> ties keep lower rows
+        order = np.argsort(dist, axis=1, kind='stable')[:, :n]
+        closest_idx = np.take_along_axis(idx, order, axis=1)
+        closest_dist = np.take_along_axis(dist, order, axis=1)
+
+    if exclude is not None:
+        closest_idx, closest_dist = exclude_rows(
+            closest_idx, closest_dist, exclude)
+    if single:
+        return closest_idx[0], closest_dist[0]
     return closest_idx, closest_dist
 
 
-def find_nn_text_2_shape(text_model, shape_model,  input_, loader, k):
-    shape_model.eval()
-    text_model.eval()
+def _encode_query(model, input_, long=False):
+    model.eval()
+    input_ = torch.from_numpy(input_).to(_model_device(model))
+    if long:
+        input_ = input_.long()
+    with torch.no_grad():
+        return model(input_)[0]
+
 
-    input_ = torch.from_numpy(input_).long()
-    if torch.cuda.is_available():
-        input_ = input_.to('cuda')
+def find_nn_text_2_text(model, input_, loader, k, embeddings=None):
+    """
+    embeddings: precomputed encode_descriptions of loader, else encoded here
+    """
 
-    criterion = torch.nn.MSELoss()
+    query = _encode_query(model, input_, long=True)
+    if embeddings is None:
+        embeddings = encode_descriptions(
+            model, loader.descriptions['description'])
+    # start with 1 to remove comparison with its own
+    return knn_search(query, embeddings, k, skip=1)
 
-    output_q = text_model(input_)
-    loss_L2 = np.array([])
-    for i in range(loader.get_shape_length()):
-        print("Calculate L2 loss for {} of {}".format(
-            i, loader.get_shape_length()), end='\r')
-        data = loader.get_shape(i)
-        data = torch.from_numpy(data).float()
-        if torch.cuda.is_available():
-            data = data.to('cuda')
-        output = shape_model(data)
-        loss_L2 = np.append(loss_L2, criterion(output_q, output).item())
-    print()
 
-    idx = np.argsort(loss_L2)
+def find_nn_shape_2_shape(model, input_, loader, k, embeddings=None):
+    query = _encode_query(model, input_)
+    if embeddings is None:
+        embeddings = encode_shapes(model, loader.shapes['data'])
     # start with 1 to remove comparison with its own
-    closest_idx = idx[1:k+1]
-    closest_dist = loss_L2[idx[1:k+1]]
-    return closest_idx, closest_dist
+    return knn_search(query, embeddings, k, skip=1)
+
+
+def find_nn_shape_2_text(shape_model, text_model, input_, loader, k,
+                         embeddings=None):
+    query = _encode_query(shape_model, input_)
+    if embeddings is None:
+        embeddings = encode_descriptions(
+            text_model, loader.descriptions['description'])
+    return knn_search(query, embeddings, k)
+
+
+def find_nn_text_2_shape(text_model, shape_model, input_, loader, k,
+                         embeddings=None):
+    query = _encode_query(text_model, input_, long=True)
+    if embeddings is None:
+        embeddings = encode_shapes(shape_model, loader.shapes['data'])
+    return knn_search(query, embeddings, k)
 
 
 def calculate_ndcg(idx_neighbor, id_input, dataloader, n_neighbors, metric):
@@ -132,30 +171,17 @@ def calculate_ndcg(idx_neighbor, id_input, dataloader, n_neighbors, metric):
     # ideal would be all nearest neighbor are from same category as input
     rel_score_ideal = np.ones((n_neighbors))
 
-    if metric == "t2t":
-        true_label = dataloader.descriptions['category'][id_input]
-        for i, id in enumerate(idx_neighbor):
-            label = dataloader.descriptions['category'][id]
-            rel_score[i] = np.asarray(label == true_label)
-    
-    if metric == "t2s":
-        true_label = dataloader.descriptions['category'][id_input]
-        for i, id in enumerate(idx_neighbor):
-            label = dataloader.shapes['category'][id]
-            rel_score[i] = np.asarray(label == true_label)
-
-    if metric == "s2t":
-        true_label = dataloader.shapes['category'][id_input]
-        for i, id in enumerate(idx_neighbor):
-            label = dataloader.descriptions['category'][id]
-            rel_score[i] = np.asarray(label == true_label)
-    
-    if metric == "s2s":
-        true_label = dataloader.shapes['category'][id_input]
-        for i, id in enumerate(idx_neighbor):
-            label = dataloader.shapes['category'][id]
-            rel_score[i] = np.asarray(label == true_label)
-        
+    if metric == "t2t" or metric == "t2s":
+        true_label = dataloader.descriptions['category_code'][id_input]
+    if metric == "s2t" or metric == "s2s":
+        true_label = dataloader.shapes['category_code'][id_input]
+
+    if metric == "t2t" or metric == "s2t":
+        labels = dataloader.descriptions['category_code'][idx_neighbor]
+    if metric == "t2s" or metric == "s2s":
+        labels = dataloader.shapes['category_code'][idx_neighbor]
+
+    rel_score[:len(labels)] = labels == true_label
 
     # Compute Discounted Cumulative Gain
     nominator = np.exp2(rel_score) - 1
@@ -0,0 +1,185 @@
+import numpy as np
+
+from utils.IVFIndex import kmeans, assign, squared_distances, exclude_rows
+
+
+class QuantizedEmbeddings(object):
+    """
+    compressed embeddings [N, emb], method
+        float16     half precision, 2 bytes per value
+        int8        scalar quantization, 1 byte per value
+                    value = min + code * (max - min) / 255 per dimension
+                    (embeddings end in sigmoid --> range is at most [0, 1])
+        pq          product quantization, emb split into n_subvectors parts
+                    each part coded by 1 byte (k-means with n_centroids)
+    queries stay float32 (asymmetric distance)
+        float16, int8   codes are decoded chunk wise
+        pq              lookup table [n_subvectors, n_centroids] with distance
+                        of each query part to each centroid, distance to a row
+                        is the sum of its table entries
+    distances are mean squared errors as in knn_search
+    codes and state (parameters) are saved separately --> codes can be
+    reopened as memory map with from_state
+    """
+
+    def __init__(self, embeddings, method="pq", n_subvectors=16,
+                 n_centroids=256, n_iter=20, train_size=None, seed=0,
+                 chunk_size=65536):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        self.method = method
+        self.n_rows, self.dim = embeddings.shape
+        self.chunk_size = chunk_size
+
+        if method == "float16":
+            self.codes = embeddings.astype(np.float16)
+        elif method == "int8":
+            self.minimum = embeddings.min(axis=0)
+            self.scale = (embeddings.max(axis=0) - self.minimum) / 255
+            self.scale[self.scale == 0] = 1
+            self.codes = np.rint(
+                (embeddings - self.minimum) / self.scale).astype(np.uint8)
+        elif method == "pq":
+            self.__train_pq(embeddings, n_subvectors, n_centroids, n_iter,
+                            train_size, seed)
+        else:
+            raise Exception(
+                "Unknown quantization {} - use float16, int8 or pq".format(
+                    method))
+
+    def __train_pq(self, embeddings, n_subvectors, n_centroids, n_iter,
+                   train_size, seed):
+        if self.dim % n_subvectors != 0:
+            raise Exception("Embedding size {} is not divisible by {} subvectors".format(
+                self.dim, n_subvectors))
+        self.n_subvectors = n_subvectors
+        self.sub_dim = self.dim // n_subvectors
+        n_centroids = max(1, min(n_centroids, 256, self.n_rows))
+        if train_size is None:
+            train_size = 256 * n_centroids
+
+        train = embeddings
+        if self.n_rows > train_size:
+            random = np.random.RandomState(seed)
+            train = train[random.choice(self.n_rows, train_size,
+                                        replace=False)]
+
+        self.centroids = np.empty((n_subvectors, n_centroids, self.sub_dim),
+                                  dtype=np.float32)
+        self.codes = np.empty((self.n_rows, n_subvectors), dtype=np.uint8)
+        for m in range(n_subvectors):
+            part = slice(m * self.sub_dim, (m + 1) * self.sub_dim)
+            self.centroids[m] = kmeans(
+                np.ascontiguousarray(train[:, part]), n_centroids, n_iter,
+                seed + m)
+            self.codes[:, m] = assign(
+                np.ascontiguousarray(embeddings[:, part]), self.centroids[m])
+
+    @classmethod
+    def from_state(cls, codes, state, chunk_size=65536):
+        """
+        quantized embeddings from saved codes and state
+        """
+
+        quantized = cls.__new__(cls)
+        quantized.method = str(state['method'])
+        quantized.codes = codes
+        quantized.n_rows = len(codes)
+        quantized.dim = int(state['dim'])
+        quantized.chunk_size = chunk_size
+        if quantized.method == "int8":
+            quantized.minimum = state['minimum']
+            quantized.scale = state['scale']
+        if quantized.method == "pq":
+            quantized.centroids = state['centroids']
+            quantized.n_subvectors, _, quantized.sub_dim = \
+                quantized.centroids.shape
+        return quantized
+
+    def state(self):
+        """
+        all parameters except codes as dict of arrays
+        """
+
+        state = {'method': np.array(self.method), 'dim': np.array(self.dim)}
+        if self.method == "int8":
+            state['minimum'] = self.minimum
+            state['scale'] = self.scale
+        if self.method == "pq":
+            state['centroids'] = self.centroids
+        return state
+
+    @property
+    def nbytes(self):
+        nbytes = self.codes.nbytes
+        if self.method == "int8":
+            nbytes += self.minimum.nbytes + self.scale.nbytes
+        if self.method == "pq":
+            nbytes += self.centroids.nbytes
+        return nbytes
+
+    def decode(self, rows):
+        """
+        float32 approximation of rows
+        """
+
+        codes = self.codes[rows]
+        if self.method == "float16":
+            return codes.astype(np.float32)
+        if self.method == "int8":
+            return codes * self.scale + self.minimum
+        return self.centroids[np.arange(self.n_subvectors), codes].reshape(
+            len(codes), self.dim)
+
+    def distances(self, queries):
+        """
+        mean squared error of each query [Q, emb] to each row --> [Q, N]
+        """
+
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        dist = np.empty((len(queries), self.n_rows), dtype=np.float32)
+
+        if self.method == "pq":
+            # one lookup table per query, rows only index into it
+            sub_queries = queries.reshape(len(queries), self.n_subvectors,
+                                          self.sub_dim)
+            subvectors = np.arange(self.n_subvectors)
+            for i, query in enumerate(sub_queries):
+                table = ((self.centroids - query[:, None, :])**2).sum(axis=2)
+                for start in range(0, self.n_rows, self.chunk_size):
+                    codes = self.codes[start:start + self.chunk_size]
+                    dist[i, start:start + self.chunk_size] = \
+                        table[subvectors, codes].sum(axis=1)
+            return dist / self.dim
+
+        for start in range(0, self.n_rows, self.chunk_size):
+            rows = np.arange(start, min(start + self.chunk_size, self.n_rows))
+            dist[:, rows] = squared_distances(queries, self.decode(rows))
+        return dist / self.dim
+
+    def search(self, queries, k, exclude=None):
+        """
+        k nearest rows for each query [Q, emb], same output as knn_search
+        exclude: row of each query [Q] if queries are part of embeddings
+                 (on codes the query is not always ranked first)
+        """
+
+        queries = np.asarray(queries, dtype=np.float32)
+        single = queries.ndim == 1
+        dist = self.distances(queries)
+
+        n = min(k + int(exclude is not None), self.n_rows)
+        if n == 0:
+            nearest = np.zeros((len(dist), 0), dtype=np.int64)
+        else:
+            nearest = np.argpartition(dist, n - 1, axis=1)[:, :n]
+        nearest_dist = np.take_along_axis(dist, nearest, axis=1)
+        order = np.argsort(nearest_dist, axis=1, kind='stable')
+        closest_idx = np.take_along_axis(nearest, order, axis=1)
+        closest_dist = np.take_along_axis(nearest_dist, order, axis=1)
+        if exclude is not None:
+            closest_idx, closest_dist = exclude_rows(
+                closest_idx, closest_dist, exclude)
+
+        if single:
+            return closest_idx[0], closest_dist[0]
+        return closest_idx, closest_dist